@@ -1,12 +1,65 @@
 import streamlit as st
 import numpy as np
-import xlsxwriter
-import graphviz
-import base64
-import io
 
+import metrics
 from streamlit_extras.badges import badge
-from funcs import *
+from artifacts import submit_export, surface, tree, tree_dot
+from funcs import LOD_MODES, lod_full_fits
+
+LOD_LABELS = {
+    'auto': 'Automatic',
+    'full': 'Every node',
+    'collapse': 'First steps and maturity',
+    'topk': 'Top and bottom nodes of each step',
+    'heatmap': 'Heatmap of payoffs',
+}
+
+# Offer an export for download, building it in the background the first time it is asked for
+def export_button(kind: str, label: str, file_name: str, mime: str, args: tuple) -> None:
+    state_key = f'export_{kind}'
+    job = st.session_state.get(state_key)
+
+    # A job for other inputs is stale
+    if job is None or job[0] != args:
+        if not st.button(label, key = f'prepare_{kind}'):
+            return
+        job = (args, submit_export(kind, *args))
+        st.session_state[state_key] = job
+
+    future = job[1]
+    if not future.done():
+        wait_for_export(future, file_name)
+    elif future.exception() is not None:
+        st.error(f"Could not build the export: {future.exception()}")
+    else:
+        st.download_button(label, future.result(), file_name = file_name, mime = mime, key = f'download_{kind}')
+
+# Poll a running export without rerunning the whole script, then rerun once to show the download button
+@st.experimental_fragment(run_every = 1)
+def wait_for_export(future, file_name: str) -> None:
+    if future.done():
+        st.rerun()
+    st.caption(f"Preparing {file_name}...")
+
+# Stage timings of the previous rerun and the running totals, only when metrics are enabled (BOPM_METRICS=1)
+def debug_panel() -> None:
+    if not metrics.enabled():
+        return
+
+    with st.expander("Debug: performance metrics"):
+        last = metrics.last_rerun()
+        if last is not None:
+            st.markdown(f"**Last rerun:** {last['ms']:.1f} ms, {last['blocks']} net memory blocks (process-wide)")
+            st.table([{'Stage': call['stage'], 'Time (ms)': round(call['ms'], 3), 'Net blocks (process)': call['blocks'], 'Nodes': call['nodes']} for call in last['stages']])
+            if 'profile' in last:
+                st.code(last['profile'])
+
+        st.markdown("**Totals since start:**")
+        st.table([
+            {'Stage': name, 'Calls': s['calls'], 'Total (ms)': round(s['ns'] / 1e6, 3), 'Max (ms)': round(s['max_ns'] / 1e6, 3), 'Net blocks (process)': s['blocks'], 'Nodes': s['nodes']}
+            for name, s in metrics.totals().items()
+        ])
+        st.caption(f"Net blocks are the change in memory blocks allocated by the whole process during a stage, so they include work done by other sessions at the same time. Prometheus metrics are written to {metrics.PROMETHEUS_PATH} after every rerun.")
 
 def main():
     col1, col2, col3 = st.columns([0.0425, 0.265, 0.035])
@@ -33,13 +86,12 @@ def main():
 
     with col_b:
         K = st.number_input("Strike price: $(K)$", min_value = 0.00, max_value = 100000000.00, value = 14.00, step = 0.01)
-        N = st.number_input("Number of future periods: $(N)$", min_value = 1, max_value = 50, value = 2, step = 1) 
+        N = st.number_input("Number of future periods: $(N)$", min_value = 1, max_value = 1000, value = 2, step = 1) 
         v = st.number_input("Annual stock volatility $(\sigma)$", min_value = 0.0000, max_value = 10000.0000, value = 0.2500, step = 0.0001, format = "%0.4f") 
         deriv_type = st.radio("Style of option:", ['European', 'American'], horizontal = True, captions = ['Exercise at expiration', 'Exercise-flexible']) 
 
-    u, d, p, pp_dict = binomial_tree(S0, K, T, N, r, v, opt_type, deriv_type)
-
-    result = final_pairs_str(pp_dict = pp_dict, all_pairs = generate_step_pairs(N))
+    # Results are cached across reruns and sessions, keyed on the inputs
+    u, d, p, pp_dict = tree(S0, K, T, N, r, v, opt_type, deriv_type)
 
     st.write('---')
 
@@ -47,12 +99,14 @@ def main():
 
     st.latex(f"S_0 = {S0}, \quad K = {K}, \quad T = {np.round(T, 4)}, \quad N = {N},  \quad \Delta t = {np.round(T/N, 4)}, \quad r = {r}, \quad \sigma = {v}")
 
-    display_str = f"""digraph {{
-        rankdir="LR"
-        node [shape="box" width="1.6" fontname="Arial"]
-        {result};
-        }}       
-        """
+    # A volatility at or below |r| * sqrt(dt) (including zero) still gives a drawable tree, just not a meaningful one
+    if not 0 < p < 1:
+        st.warning("With σ at or below |r|·√Δt the up probability p is outside (0, 1), so the prices in this tree are not meaningful. Increase σ or N.")
+
+    # Large trees are drawn at a lower level of detail so that the graph stays readable and quick to lay out
+    detail_modes = [mode for mode in LOD_MODES if mode != 'full' or lod_full_fits(N)]
+    detail = st.selectbox("Graph detail:", detail_modes, format_func = lambda mode: LOD_LABELS[mode], help = "Automatic draws every node of small trees, and only the top and bottom nodes of evenly spaced steps of large ones.")
+    display_str = tree_dot(S0, K, T, N, r, v, opt_type, deriv_type, detail)
 
     st.graphviz_chart(display_str, use_container_width = True)
 
@@ -60,157 +114,37 @@ def main():
 
     col_x, col_y = st.columns([1, 0.36])
 
+    # Exports are only built when asked for, in the background, and served as downloads rather than inlined
     with col_x:
-        # Obtain data from calculations and write to .xlsx file
-        def to_excel():
-            output = io.BytesIO()
-            
-            # Create a new Excel workbook
-            workbook = xlsxwriter.Workbook(output)
-
-            # Add a worksheet to the workbook
-            worksheet = workbook.add_worksheet("tree_vals")
-
-            # Add formats and templates here
-            current_payoff = workbook.add_format(
-                {
-                    'bg_color': '#DAF2D0',
-                    'bold': True,
-                    'border': 1,
-                    'num_format': '0.0000' 
-                }
-            )
-
-            header_format = workbook.add_format(
-                {
-                    'bold': True,
-                    'underline': True,
-                    'align': 'left'
-                }
-            ) 
-
-            variable_format = workbook.add_format(
-                {
-                    'bold': True,
-                    'align': 'right'
-                }
-            )
-            
-            user_str_format = workbook.add_format(
-                {
-                    'align': 'right'
-                }
-            )  
-
-            numeric_format = workbook.add_format(
-                {
-                    'num_format': '0.0000'
-                }
-            ) 
-
-            description_format = workbook.add_format(
-                {
-                    'italic': True
-                }
-            )
-
-            # Write data to the worksheet
-            worksheet.write("A1", "User inputs:", header_format)
-            worksheet.write("A12", "Calculated constants:", header_format)
-            worksheet.write("A18", "Prices and payoffs:", header_format)
-
-            variables = ["S_0", "K", "T", "N", "Δt", "r", "σ", "Opt Type", "Opt Style"]
-            constants = ["u", "d", "p", "1 - p"]
-
-            r1, c1 = 1, 0
-            for i in variables:
-                worksheet.write(r1, c1, i, variable_format)
-                r1 += 1
-
-            r2, c2 = 12, 0
-            for j in constants:
-                worksheet.write(r2, c2, j, variable_format)
-                r2 += 1
-
-            worksheet.write("B2", S0, numeric_format)
-            worksheet.write("B3", K, numeric_format)
-            worksheet.write("B4", T, numeric_format)
-            worksheet.write("B5", N, numeric_format)
-            worksheet.write("B6", T/N, numeric_format)
-            worksheet.write("B7", r, numeric_format)
-            worksheet.write("B8", v, numeric_format)
-            worksheet.write("B9", opt_type, user_str_format)
-            worksheet.write("B10", deriv_type, user_str_format)
-
-            worksheet.write("B13", u, numeric_format)
-            worksheet.write("B14", d, numeric_format)
-            worksheet.write("B15", p, numeric_format)
-            worksheet.write("B16", 1 - p, numeric_format) 
-
-            r3, c3 = 18, 0
-            sorted_dict = dict(sorted(pp_dict.items(), key=lambda x: x[0]))
-            for key, val in sorted_dict.items():
-                worksheet.write(r3, c3, f"Price {key}", variable_format)
-                c3 += 1
-                worksheet.write(r3, c3, val[0], numeric_format)
-                c3 += 1
-                worksheet.write(r3, c3, f"Payoff {key}", variable_format)
-                c3 += 1
-                worksheet.write(r3, c3, val[1], numeric_format)
-                c3 -= 3
-                r3 += 1
-
-            worksheet.write("D19", pp_dict[1][1], current_payoff)
-
-            worksheet.write("D2", "Initial stock price", description_format)
-            worksheet.write("D3", "Strike price", description_format)
-            worksheet.write("D4", "Time to maturity (in years)", description_format)
-            worksheet.write("D5", "No. of future periods", description_format)
-            worksheet.write("D6", "Time step between each period (T/N)", description_format)
-            worksheet.write("D7", "Annual discount rate (continuous compounding)", description_format)
-            worksheet.write("D8", "Annual stock volatility", description_format)
-            worksheet.write("D9", "Type of option (Call or Put)", description_format)
-            worksheet.write("D10", "Style of option (European or American)", description_format)
-
-            worksheet.write("D13", "Up rate of the stock", description_format)
-            worksheet.write("D14", "Down rate of the stock", description_format)
-            worksheet.write("D15", "Probability stock price will go up (by u) in next period", description_format)
-            worksheet.write("D16", "Probability stock price will go down (by d) in next period", description_format)
-
-            # Set width of columns
-            worksheet.set_column("A:A", 10)
-            worksheet.set_column("B:B", 16)
-            worksheet.set_column("C:C", 10)
-            worksheet.set_column("D:D", 16)
-
-            # Hide gridlines in the worksheet
-            worksheet.hide_gridlines(2)
-
-            # Saving and returning data
-            workbook.close()
-            processed_data = output.getvalue()
-
-            return base64.b64encode(processed_data).decode()
-
-        href = f'<a href="data:application/octet-stream;base64,{to_excel()}" download="btree_details.xlsx">📝 Download data (.xlsx)</a>' 
-        st.markdown(href, unsafe_allow_html = True)
+        export_button('xlsx', "📝 Download data (.xlsx)", "btree_details.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", (S0, K, T, N, r, v, opt_type, deriv_type))
 
     with col_y:
-        # Turn graph into graphviz object
-        graph = graphviz.Source(display_str)
-
-        # Render the graph as a PDF file
-        def to_pdf(graph):
-            pdf_data = graph.pipe(format = 'pdf')
-            pdf_base64 = base64.b64encode(pdf_data).decode()
-            return pdf_base64
-
-        # Provide a download button for the PDF image
-        href = f'<a href="data:application/pdf;base64,{to_pdf(graph)}" download="btree_graph.pdf">📈 Download graph (.pdf)</a>'
-        st.markdown(href, unsafe_allow_html = True)
+        export_button('pdf', "📈 Download graph (.pdf)", "btree_graph.pdf", "application/pdf", (S0, K, T, N, r, v, opt_type, deriv_type, detail))
 
     st.markdown(f"##### Current Payoff at time $T_0$ = {np.round(pp_dict[1][1], 4)}")
 
+    # What-if surface, priced in one pass of an extended lattice
+    spots, vols, grid = surface(S0, K, T, N, r, v, opt_type, deriv_type) if S0 > 0 and v > 0 else (None, np.empty(0), None)
+    if vols.size:
+        with st.expander("Scenario analysis: spot and volatility"):
+            field = st.radio("Show:", ['price', 'delta'], horizontal = True, format_func = str.capitalize)
+            records = [
+                {'Spot': round(spot, 4), 'Volatility': round(vol, 4), field: round(value, 4)}
+                for spot, row in zip(spots.tolist(), grid[field].tolist())
+                for vol, value in zip(vols.tolist(), row)
+            ]
+            st.vega_lite_chart({
+                'data': {'values': records},
+                'mark': 'rect',
+                'encoding': {
+                    'x': {'field': 'Spot', 'type': 'ordinal', 'axis': {'labelAngle': -45}},
+                    'y': {'field': 'Volatility', 'type': 'ordinal', 'sort': 'descending'},
+                    'color': {'field': field, 'type': 'quantitative', 'scale': {'scheme': 'greens'}},
+                    'tooltip': [{'field': 'Spot'}, {'field': 'Volatility'}, {'field': field}],
+                },
+            }, use_container_width = True)
+            st.caption("Spot ladder of S0 ± 20% in 41 steps and volatilities of σ ± 50%, all priced in a single backward pass of a tree extended into the past.")
+
     with st.expander("How does the Binomial Options Pricing Model work?"):
         st.markdown("The Binomial Options Pricing Model estimates option prices by simulating the possible movements of an asset's price over time, assuming it can only move up or down by a specified fixed amount and that the risk-neutral probabilities of these movements are known.")
         
@@ -369,4 +303,6 @@ def main():
 
 if __name__ == "__main__":
     st.set_page_config(page_title = "BOPM Visusalisation", page_icon = "💵")
-    main()
+    with metrics.rerun():
+        main()
+    debug_panel()
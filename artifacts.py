@@ -0,0 +1,266 @@
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Tuple
+
+import graphviz
+import numpy as np
+import xlsxwriter
+
+from cache import cached, normalize_key
+from metrics import stage, timed, tree_nodes
+from store import stored_lattice
+from funcs import final_pairs_str, generate_step_pairs, lattice_levels, level_of_detail_str, lod_mode, lod_steps, spot_vol_surface
+
+# Artifacts shown or offered for download by the app. Each is memoized process-wide on its normalized inputs, so
+# identical views (in the same session or any other) skip both the lattice maths and the graphviz subprocess.
+
+# Get u, d, p and the node prices and payoffs of a tree. Large trees come from the on-disk store when another
+# process has already built them. The result is read-only, since it is shared between sessions.
+@cached('tree', max_entries = 256, max_bytes = 256 * 2**20)
+@timed('binomial_tree', tree_nodes)
+def tree(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str):
+    u, d, p, lattice = stored_lattice(S0, K, T, N, r, v, opt_type, deriv_type)
+    return u, d, p, lattice.nodes
+
+# Get the graphviz DOT source of a tree
+@cached('dot', max_entries = 256, max_bytes = 64 * 2**20)
+def tree_dot(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, mode: str = 'auto') -> str:
+    # Small trees are drawn in full from the cached lattice, larger ones only compute the levels they draw
+    mode = lod_mode(N, mode)
+    if mode == 'full':
+        _, _, _, pp_dict = tree(S0, K, T, N, r, v, opt_type, deriv_type)
+        with stage('final_pairs_str', len(pp_dict)):
+            result = final_pairs_str(pp_dict = pp_dict, all_pairs = generate_step_pairs(N))
+    else:
+        steps = lod_steps(N, mode)
+        with stage('lattice_levels', tree_nodes(S0, K, T, N)):
+            _, _, _, levels = lattice_levels(S0, K, T, N, r, v, opt_type, deriv_type, steps = steps)
+        with stage(f'level_of_detail_{mode}', sum(len(levels[i][0]) for i in steps)):
+            result = level_of_detail_str(levels, N, mode)
+
+    return f"""digraph {{
+        rankdir="LR"
+        node [shape="box" width="1.6" fontname="Arial"]
+        {result};
+        }}       
+        """
+
+# Get the price and delta surface over a spot ladder (S0 +/- 20% in 41 steps) and a volatility grid (v +/- 50%).
+# Volatilities at or below |r| * sqrt(T/N) give the tree an up probability outside [0, 1] and are left out, so the
+# grid may come back empty.
+@cached('surface', max_entries = 128, max_bytes = 64 * 2**20)
+@timed('spot_vol_surface')
+def surface(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str):
+    spots = S0 * np.linspace(0.8, 1.2, 41)
+    vols = np.unique(np.maximum(v * np.linspace(0.5, 1.5, 11), 0.01))
+    vols = vols[vols > abs(r) * np.sqrt(T/N)]
+    if vols.size:
+        result = spot_vol_surface(S0, K, T, N, r, spots, vols, opt_type, deriv_type)
+    else:
+        result = np.empty(spots.shape + vols.shape, dtype = [('price', float), ('delta', float)])
+
+    # The result is shared between sessions, so it must not be changed in place
+    for array in (spots, vols, result):
+        array.flags.writeable = False
+
+    return spots, vols, result
+
+# Render a tree to PDF with graphviz
+@cached('pdf', max_entries = 128, max_bytes = 128 * 2**20)
+@timed('graphviz_pdf')
+def to_pdf(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, mode: str = 'auto') -> bytes:
+    graph = graphviz.Source(tree_dot(S0, K, T, N, r, v, opt_type, deriv_type, mode))
+    return graph.pipe(format = 'pdf')
+
+# Largest tree exported as one row per node, larger trees get the triangular layout
+XLSX_NODE_LIST_MAX_STEPS = 50
+
+# Write one value per node as a triangle, with a column per time step and a row per number of down moves
+def _write_triangle(workbook, name: str, values: np.ndarray, N: int, formats: Dict) -> None:
+    worksheet = workbook.add_worksheet(name)
+
+    # Cells written without a format take the format of their column
+    worksheet.set_column(0, 0, 18, formats['variable'])
+    worksheet.set_column(1, N + 1, 10, formats['numeric'])
+    worksheet.freeze_panes(1, 1)
+
+    worksheet.write(0, 0, "Down moves \\ Step", formats['header'])
+    worksheet.write_row(0, 1, range(N + 1), formats['variable'])
+
+    # constant_memory only keeps the current row, so the triangle is written row by row: node (i, down) sits at
+    # flat index i(i+1)/2 + down, gathered for every step at once
+    starts = np.arange(N + 1) * np.arange(1, N + 2) // 2
+    for down in range(N + 1):
+        worksheet.write(down + 1, 0, down)
+        worksheet.write_row(down + 1, 1 + down, values[starts[down:] + down].tolist())
+
+# Obtain data from calculations and write to .xlsx file
+@cached('xlsx', max_entries = 128, max_bytes = 64 * 2**20)
+@timed('to_excel', tree_nodes)
+def to_excel(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, layout: str = 'auto') -> bytes:
+    '''
+    Builds the workbook with the inputs, the constants and every node of the tree.
+
+    With layout 'nodes' the nodes are listed one per row under the constants (Price 1, Payoff 1, Price 2, ...). With
+    layout 'triangle' the prices and payoffs go on their own sheets, one column per time step, which stays readable
+    for thousands of steps. 'auto' lists the nodes of trees with up to XLSX_NODE_LIST_MAX_STEPS steps.
+
+    The workbook is streamed in xlsxwriter's constant_memory mode, so every sheet is written strictly in row order.
+    '''
+    if layout == 'auto':
+        layout = 'nodes' if N <= XLSX_NODE_LIST_MAX_STEPS else 'triangle'
+    if layout not in ('nodes', 'triangle'):
+        raise ValueError(f"layout must be 'auto', 'nodes' or 'triangle', not {layout!r}")
+
+    u, d, p, pp_dict = tree(S0, K, T, N, r, v, opt_type, deriv_type)
+    lattice = pp_dict.lattice
+
+    output = io.BytesIO()
+    
+    # Create a new Excel workbook
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+
+    # Add a worksheet to the workbook
+    worksheet = workbook.add_worksheet("tree_vals")
+
+    # Add formats and templates here
+    current_payoff = workbook.add_format(
+        {
+            'bg_color': '#DAF2D0',
+            'bold': True,
+            'border': 1,
+            'num_format': '0.0000' 
+        }
+    )
+
+    header_format = workbook.add_format(
+        {
+            'bold': True,
+            'underline': True,
+            'align': 'left'
+        }
+    ) 
+
+    variable_format = workbook.add_format(
+        {
+            'bold': True,
+            'align': 'right'
+        }
+    )
+    
+    user_str_format = workbook.add_format(
+        {
+            'align': 'right'
+        }
+    )  
+
+    numeric_format = workbook.add_format(
+        {
+            'num_format': '0.0000'
+        }
+    ) 
+
+    description_format = workbook.add_format(
+        {
+            'italic': True
+        }
+    )
+
+    # Set width and default format of columns
+    worksheet.set_column("A:A", 10, variable_format)
+    worksheet.set_column("B:B", 16, numeric_format)
+    worksheet.set_column("C:C", 10, variable_format)
+    worksheet.set_column("D:D", 16, numeric_format)
+
+    # Hide gridlines in the worksheet
+    worksheet.hide_gridlines(2)
+
+    variables = [
+        ("S_0", S0, numeric_format, "Initial stock price"),
+        ("K", K, numeric_format, "Strike price"),
+        ("T", T, numeric_format, "Time to maturity (in years)"),
+        ("N", N, numeric_format, "No. of future periods"),
+        ("Δt", T/N, numeric_format, "Time step between each period (T/N)"),
+        ("r", r, numeric_format, "Annual discount rate (continuous compounding)"),
+        ("σ", v, numeric_format, "Annual stock volatility"),
+        ("Opt Type", opt_type, user_str_format, "Type of option (Call or Put)"),
+        ("Opt Style", deriv_type, user_str_format, "Style of option (European or American)"),
+    ]
+
+    constants = [
+        ("u", u, "Up rate of the stock"),
+        ("d", d, "Down rate of the stock"),
+        ("p", p, "Probability stock price will go up (by u) in next period"),
+        ("1 - p", 1 - p, "Probability stock price will go down (by d) in next period"),
+    ]
+
+    # Write data to the worksheet, in row order
+    worksheet.write("A1", "User inputs:", header_format)
+    for row, (name, value, value_format, description) in enumerate(variables, start = 1):
+        worksheet.write(row, 0, name)
+        worksheet.write(row, 1, value, value_format)
+        worksheet.write(row, 3, description, description_format)
+
+    worksheet.write("A12", "Calculated constants:", header_format)
+    for row, (name, value, description) in enumerate(constants, start = 12):
+        worksheet.write(row, 0, name)
+        worksheet.write(row, 1, value)
+        worksheet.write(row, 3, description, description_format)
+
+    worksheet.write("A18", "Prices and payoffs:", header_format)
+    worksheet.write_row("A19", [f"Price 1", lattice.prices[0], f"Payoff 1"])
+    worksheet.write("D19", lattice.payoffs[0], current_payoff)
+
+    if layout == 'nodes':
+        # Nodes are already stored in node number order
+        for key, price, payoff in zip(range(2, len(lattice) + 1), lattice.prices[1:].tolist(), lattice.payoffs[1:].tolist()):
+            worksheet.write_row(key + 17, 0, [f"Price {key}", price, f"Payoff {key}", payoff])
+    else:
+        worksheet.write("A20", "Every node is on the 'prices' and 'payoffs' sheets, with one column per time step and one row per number of down moves.", description_format)
+
+        formats = {'header': header_format, 'variable': variable_format, 'numeric': numeric_format}
+        _write_triangle(workbook, "prices", lattice.prices, lattice.N, formats)
+        _write_triangle(workbook, "payoffs", lattice.payoffs, lattice.N, formats)
+
+    # Saving and returning data
+    workbook.close()
+    return output.getvalue()
+
+# Downloads built by submit_export
+EXPORTS = {'xlsx': to_excel, 'pdf': to_pdf}
+
+# Exports run on a small pool, off the script thread, and only once somebody asks for them
+EXPORT_WORKERS = 2
+_export_pool = ThreadPoolExecutor(EXPORT_WORKERS, thread_name_prefix = 'export')
+_in_flight: Dict[Tuple, Future] = {}
+_in_flight_lock = threading.Lock()
+
+def submit_export(kind: str, *args) -> Future:
+    '''
+    Starts building an export in the background and returns its future. Concurrent requests for the same export
+    (from any session) share one build, and exports already in the cache come back as a finished future.
+    '''
+    func = EXPORTS[kind]
+    key = (kind,) + normalize_key(func.__wrapped__, args, {})
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+
+        if key[1:] in func.cache:
+            future = Future()
+            future.set_result(func(*args))
+            return future
+
+        future = _export_pool.submit(func, *args)
+        _in_flight[key] = future
+
+    # Once built, the export is served from the cache
+    def forget(_):
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+
+    future.add_done_callback(forget)
+    return future
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+import funcs
+
+# Offline benchmarks for the pricing, graph and export paths. Each case records its best wall time, peak traced
+# memory and the number of memory blocks it leaves allocated once its result is dropped, and runs can be saved as
+# JSON baselines and compared.
+#
+#   python bench.py run -o baseline.json
+#   python bench.py run -o current.json
+#   python bench.py compare baseline.json current.json --threshold 0.25
+#   python bench.py models
+
+CONTRACT = dict(S0 = 100.0, K = 100.0, T = 1.0, r = 0.05, v = 0.2)
+VARIANTS = [(opt_type, deriv_type) for opt_type in ['Call', 'Put'] for deriv_type in ['European', 'American']]
+
+# Wrap a case that needs no setup
+def _ready(func: Callable) -> Callable[[], Callable]:
+    return lambda: func
+
+# Yield (name, setup) for every benchmark case. setup() does any preparation (building trees, filling the lattice
+# store, importing the app's modules) and returns the callable to time, so cases filtered out by -k cost nothing.
+def cases(quick: bool = False) -> Iterator[Tuple[str, Callable[[], Callable]]]:
+    price_steps = [10, 100, 1000, 10000] + ([] if quick else [100000])
+    tree_steps = [10, 100] + ([] if quick else [1000])
+    batch_sizes = [1, 100, 10000] + ([] if quick else [100000])
+    graph_steps = [10, 50] + ([] if quick else [200])
+    c = CONTRACT
+
+    for opt_type, deriv_type in VARIANTS:
+        tag = f'{opt_type.lower()}_{deriv_type.lower()}'
+
+        for N in price_steps:
+            yield f'binomial_price/{tag}/N={N}', _ready(lambda N = N, o = opt_type, d = deriv_type: funcs.binomial_price(c['S0'], c['K'], c['T'], N, c['r'], c['v'], o, d))
+
+        for N in tree_steps:
+            yield f'binomial_tree/{tag}/N={N}', _ready(lambda N = N, o = opt_type, d = deriv_type: funcs.binomial_tree(c['S0'], c['K'], c['T'], N, c['r'], c['v'], o, d))
+
+        for size in batch_sizes:
+            strikes = np.linspace(50, 150, size)
+            yield f'binomial_tree_batch/{tag}/N=100/batch={size}', _ready(lambda K = strikes, o = opt_type, d = deriv_type: funcs.binomial_tree_batch(c['S0'], K, c['T'], 100, c['r'], c['v'], o, d))
+
+    # All four variants of a 21-strike ladder from one lattice
+    ladder = np.linspace(80, 120, 21)
+    for N in [100, 1000] + ([] if quick else [5000]):
+        yield f'binomial_variants/N={N}/strikes=21', _ready(lambda N = N: funcs.binomial_variants(c['S0'], ladder, c['T'], N, c['r'], c['v']))
+
+    # A 41-spot ladder by 11 volatilities from one extended lattice
+    spots, vols = c['S0'] * np.linspace(0.8, 1.2, 41), c['v'] * np.linspace(0.5, 1.5, 11)
+    for N in [100, 1000]:
+        yield f'spot_vol_surface/N={N}/grid=41x11', _ready(lambda N = N: funcs.spot_vol_surface(c['S0'], c['K'], c['T'], N, c['r'], spots, vols, 'Put', 'American'))
+
+    # Format a prebuilt tree, so that only the string building is timed
+    def final_pairs(N: int) -> Callable:
+        _, _, _, pp_dict = funcs.binomial_tree(c['S0'], c['K'], c['T'], N, c['r'], c['v'])
+        pairs = funcs.generate_step_pairs(N)
+        return lambda: funcs.final_pairs_str(pp_dict, pairs)
+
+    for N in graph_steps:
+        yield f'generate_step_pairs/N={N}', _ready(lambda N = N: funcs.generate_step_pairs(N))
+        yield f'final_pairs_str/N={N}', lambda N = N: final_pairs(N)
+
+    for N in [100, 1000] + ([] if quick else [5000]):
+        for mode in ['collapse', 'topk', 'heatmap']:
+            yield f'level_of_detail/{mode}/N={N}', _ready(lambda N = N, mode = mode: funcs.level_of_detail_str(funcs.lattice_levels(c['S0'], c['K'], c['T'], N, c['r'], c['v'], 'Put', 'American', funcs.lod_steps(N, mode))[3], N, mode))
+
+    # Warm loads from the on-disk lattice store, against building the same lattice
+    def stored(args: Tuple) -> Callable:
+        from store import LatticeStore
+
+        lattice_store = LatticeStore(os.path.join(tempfile.gettempdir(), 'bopm_bench_store'))
+        if lattice_store.get(*args) is None:
+            lattice_store.put(*args, *funcs.binomial_lattice(*args))
+        return lambda: lattice_store.get(*args)
+
+    for N in [500] + ([] if quick else [2000]):
+        args = (c['S0'], c['K'], c['T'], N, c['r'], c['v'], 'Put', 'American')
+        yield f'binomial_lattice/N={N}', _ready(lambda args = args: funcs.binomial_lattice(*args))
+        yield f'lattice_store_warm/N={N}', lambda args = args: stored(args)
+
+    # The export functions are memoized, so time the undecorated builder
+    def excel(N: int) -> Callable:
+        from artifacts import to_excel
+
+        return lambda: to_excel.__wrapped__(c['S0'], c['K'], c['T'], N, c['r'], c['v'], 'Call', 'European')
+
+    for N in graph_steps:
+        yield f'to_excel/N={N}', lambda N = N: excel(N)
+
+# Time a callable, repeating it until `budget` seconds have been spent (at least once, at most `max_repeats`)
+def measure(func: Callable, budget: float = 0.5, max_repeats: int = 20) -> Dict[str, float]:
+    '''
+    Returns:
+        - result (Dict[str, float]): The best wall time in seconds and the number of repeats, the peak traced memory
+          of one call in bytes, and the memory blocks the call left allocated once its result is dropped (caches,
+          leaks), which is 0 for a call that frees everything it allocates.
+    '''
+    timings = []
+    while len(timings) < max_repeats and sum(timings) < budget:
+        start = time.perf_counter_ns()
+        func()
+        timings.append((time.perf_counter_ns() - start) / 1e9)
+
+    # Memory is traced in a separate call, since tracing slows everything down. The result is dropped before the
+    # second snapshot, so that only what the call itself kept alive is counted.
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    del result
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Ignore the frames tracemalloc itself holds for the first snapshot
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(stat.count_diff for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters), 'filename'))
+
+    return {
+        'seconds': min(timings),
+        'repeats': len(timings),
+        'peak_bytes': peak,
+        'retained_blocks': blocks,
+    }
+
+def run(output: str, quick: bool = False, match: str = None, budget: float = 0.5) -> Dict:
+    results = {}
+    for name, setup in cases(quick):
+        if match and match not in name:
+            continue
+        results[name] = measure(setup(), budget)
+        r = results[name]
+        print(f'{name:55s} {r["seconds"] * 1e3:12.3f} ms {r["peak_bytes"] / 2**20:10.2f} MiB {r["retained_blocks"]:8d} blocks retained', flush = True)
+
+    report = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(timespec = 'seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    return report
+
+def compare(baseline: str, current: str, threshold: float = 0.25, memory_threshold: float = 0.25, min_seconds: float = 1e-3) -> List[str]:
+    '''
+    Compares two saved runs case by case.
+
+    A case regresses if its time grew by more than `threshold` (as a fraction, ignoring cases faster than
+    `min_seconds` in the baseline, which are mostly noise) or its peak memory grew by more than `memory_threshold`.
+
+    Returns:
+        - regressions (List[str]): Names of the cases that regressed.
+    '''
+    with open(baseline) as f:
+        base = json.load(f)['results']
+    with open(current) as f:
+        cur = json.load(f)['results']
+
+    regressions = []
+    for name in sorted(base.keys() & cur.keys()):
+        b, c = base[name], cur[name]
+        time_ratio = c['seconds'] / b['seconds'] if b['seconds'] > 0 else 1.0
+        memory_ratio = c['peak_bytes'] / b['peak_bytes'] if b['peak_bytes'] > 0 else 1.0
+
+        slow = b['seconds'] >= min_seconds and time_ratio > 1 + threshold
+        heavy = memory_ratio > 1 + memory_threshold
+        flag = 'REGRESSION' if slow or heavy else ''
+        if flag:
+            regressions.append(name)
+
+        print(f'{name:55s} time x{time_ratio:6.2f}   memory x{memory_ratio:6.2f}   {flag}')
+
+    for name in sorted(base.keys() - cur.keys()):
+        print(f'{name:55s} missing from {current}')
+
+    return regressions
+
+# Steps of the reference tree for American options, which have no closed form
+REFERENCE_STEPS = 20000
+
+def models(steps: List[int] = None, output: str = None, budget: float = 0.2) -> List[Dict]:
+    '''
+    Prices the benchmark contract with every lattice model at increasing N, and reports the absolute error against a
+    reference next to the runtime, so that the models can be compared at equal cost. The reference is Black-Scholes
+    for European options and a BBSR tree with REFERENCE_STEPS steps for American ones.
+
+    Returns:
+        - rows (List[Dict]): One row per variant, model and N with the price, error and seconds.
+    '''
+    steps = steps or [25, 50, 100, 200, 400, 800, 1600]
+    c = CONTRACT
+
+    rows = []
+    for opt_type, deriv_type in VARIANTS:
+        if deriv_type == 'European':
+            reference = funcs.black_scholes(c['S0'], c['K'], c['T'], c['r'], c['v'], opt_type)
+        else:
+            reference = funcs.binomial_price(c['S0'], c['K'], c['T'], REFERENCE_STEPS, c['r'], c['v'], opt_type, deriv_type, 'bbsr')
+
+        for model in funcs.MODELS:
+            for N in steps:
+                func = lambda N = N, m = model: funcs.binomial_price(c['S0'], c['K'], c['T'], N, c['r'], c['v'], opt_type, deriv_type, model = m)
+                price = func()
+                timings = []
+                while not timings or sum(timings) < budget and len(timings) < 20:
+                    start = time.perf_counter_ns()
+                    func()
+                    timings.append((time.perf_counter_ns() - start) / 1e9)
+
+                row = {'variant': f'{opt_type.lower()}_{deriv_type.lower()}', 'model': model, 'N': N, 'price': price, 'error': abs(price - reference), 'seconds': min(timings)}
+                rows.append(row)
+                print(f'{row["variant"]:15s} {model:10s} N={N:<6d} error {row["error"]:10.3e} {row["seconds"] * 1e3:10.3f} ms', flush = True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(rows, f, indent = 2)
+
+    return rows
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Benchmark the pricing, graph and export paths.')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = commands.add_parser('run', help = 'run the benchmarks and save the results as JSON')
+    run_parser.add_argument('-o', '--output', default = 'bench_results.json', help = 'JSON file to write (default: bench_results.json)')
+    run_parser.add_argument('--quick', action = 'store_true', help = 'skip the largest cases')
+    run_parser.add_argument('-k', '--match', help = 'only run cases whose name contains this string')
+    run_parser.add_argument('--budget', type = float, default = 0.5, help = 'seconds spent repeating each case (default: 0.5)')
+
+    compare_parser = commands.add_parser('compare', help = 'compare two saved runs, failing on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type = float, default = 0.25, help = 'allowed fractional slowdown (default: 0.25)')
+    compare_parser.add_argument('--memory-threshold', type = float, default = 0.25, help = 'allowed fractional growth in peak memory (default: 0.25)')
+    compare_parser.add_argument('--min-seconds', type = float, default = 1e-3, help = 'ignore timings of cases faster than this in the baseline (default: 0.001)')
+
+    models_parser = commands.add_parser('models', help = 'compare the error and runtime of the lattice models')
+    models_parser.add_argument('--steps', type = int, nargs = '+', help = 'values of N to price at (default: 25 to 1600)')
+    models_parser.add_argument('-o', '--output', help = 'also save the rows as JSON')
+    models_parser.add_argument('--budget', type = float, default = 0.2, help = 'seconds spent repeating each price (default: 0.2)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run(args.output, args.quick, args.match, args.budget)
+    elif args.command == 'models':
+        models(args.steps, args.output, args.budget)
+    else:
+        regressions = compare(args.baseline, args.current, args.threshold, args.memory_threshold, args.min_seconds)
+        if regressions:
+            print(f'{len(regressions)} case(s) regressed', file = sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+import numpy as np
+
+# Bounded LRU cache for one kind of artifact (lattices, DOT strings, PDFs, workbooks, ...)
+class ResultCache:
+    '''
+    Thread-safe least-recently-used cache, bounded both by entry count and by the total size of the stored values.
+
+    Parameters:
+    - name (str): Name of the artifact kind, used in stats
+    - max_entries (int): Maximum number of values kept
+    - max_bytes (int): Maximum total size of the values kept, as measured by sizeof()
+    '''
+    def __init__(self, name: str, max_entries: int = 128, max_bytes: int = 64 * 2**20):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    # Get a value and mark it as most recently used, or return `default` on a miss
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Store a value, evicting least recently used values until both bounds hold
+    def put(self, key: Hashable, value: Any) -> None:
+        size = sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+
+            # A value larger than the whole budget is never kept
+            if size > self.max_bytes:
+                return
+
+            self._data[key] = (value, size)
+            self.nbytes += size
+
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last = False)
+                self.nbytes -= old_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._data),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# Approximate size in bytes of a cached value
+def sizeof(value: Any) -> int:
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sizeof(x) for x in value)
+    return sys.getsizeof(value)
+
+# Turn call arguments into a hashable key that does not depend on how the function was called
+def normalize_key(func: Callable, args: Tuple, kwargs: Dict) -> Tuple:
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return tuple(_normalize(x) for x in bound.arguments.values())
+
+def _normalize(x: Any) -> Hashable:
+    if isinstance(x, np.generic):
+        x = x.item()
+    if isinstance(x, float):
+        # 0.0 and -0.0 compare equal but format differently in labels
+        return x + 0.0
+    if isinstance(x, (list, tuple)):
+        return tuple(_normalize(y) for y in x)
+    return x
+
+# One cache per artifact kind, shared by every session in the process
+_caches: Dict[str, ResultCache] = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name: str, max_entries: int = 128, max_bytes: int = 64 * 2**20) -> ResultCache:
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = ResultCache(name, max_entries, max_bytes)
+        return _caches[name]
+
+# Hit/miss counters and sizes of every artifact cache
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    with _caches_lock:
+        return {name: cache.stats() for name, cache in _caches.items()}
+
+def cached(name: str, max_entries: int = 128, max_bytes: int = 64 * 2**20) -> Callable:
+    '''
+    Decorator that memoizes a function in the process-wide cache for the artifact kind `name`. The key is the
+    normalized tuple of the call arguments, with defaults filled in.
+
+    The wrapped function gains a `cache` attribute pointing at its ResultCache.
+    '''
+    cache = get_cache(name, max_entries, max_bytes)
+    missing = object()
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = normalize_key(func, args, kwargs)
+            value = cache.get(key, missing)
+            if value is missing:
+                value = func(*args, **kwargs)
+                cache.put(key, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
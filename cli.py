@@ -0,0 +1,227 @@
+import argparse
+import csv
+import itertools
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from funcs import binomial_tree_batch
+
+# Headless bulk pricing: stream contracts from a CSV or Parquet file, price them chunk by chunk with the vectorized
+# engine across a process pool, and write the results in the original row order.
+#
+#   python cli.py contracts.csv prices.csv --steps 200 --chunk-size 50000 --workers 4
+
+NUMERIC_COLUMNS = ['S0', 'K', 'T', 'r', 'v']
+DEFAULTS = {'opt_type': 'Call', 'deriv_type': 'European'}
+RESULT_COLUMNS = ['price', 'u', 'd', 'p']
+GREEK_COLUMNS = ['delta', 'gamma', 'theta', 'vega', 'rho']
+
+# Column of the output holding why a row could not be priced, empty for rows that were
+ERROR_COLUMN = 'error'
+
+# Convert a column to floats, with NaN wherever a cell is blank or not a number
+def _to_float(values) -> np.ndarray:
+    try:
+        return np.asarray(values, dtype = float)
+    except (TypeError, ValueError):
+        out = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                out[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return out
+
+# Check every row of a chunk, returning an error message per row ('' for valid rows)
+def _row_errors(inputs: Dict[str, np.ndarray], N: np.ndarray) -> np.ndarray:
+    errors = np.full(len(N), '', dtype = object)
+
+    # Later checks only fill rows without an earlier error
+    def flag(bad: np.ndarray, message: str) -> None:
+        errors[bad & (errors == '')] = message
+
+    for name in NUMERIC_COLUMNS:
+        flag(~np.isfinite(inputs[name]), f'{name} is not a number')
+    flag(~np.isfinite(N) | (N < 1) | (N != np.round(N)), 'N must be a positive integer')
+    with np.errstate(invalid = 'ignore'):
+        flag(~((inputs['S0'] > 0) & (inputs['T'] > 0)), 'S0 and T must be positive')
+        flag(~(inputs['v'] > np.abs(inputs['r']) * np.sqrt(inputs['T'] / N)), 'v must exceed |r| * sqrt(T / N)')
+    flag(~np.isin(inputs['opt_type'], ['Call', 'Put']), "opt_type must be 'Call' or 'Put'")
+    flag(~np.isin(inputs['deriv_type'], ['European', 'American']), "deriv_type must be 'European' or 'American'")
+    return errors
+
+# Price one chunk of contracts. Runs in a worker process, so it only takes and returns plain arrays.
+def price_chunk(columns: Dict[str, np.ndarray], steps: int, greeks: bool = False) -> Dict[str, np.ndarray]:
+    '''
+    Prices one chunk of contracts. Rows that are invalid (blank or non-numeric cells, p outside (0, 1), unknown
+    types) or that the engine fails on get NaN results and a message in ERROR_COLUMN, so that one bad row never
+    stops the rest of the file.
+    '''
+    size = len(columns['S0'])
+    names = RESULT_COLUMNS + (GREEK_COLUMNS if greeks else [])
+    out = {name: np.full(size, np.nan) for name in names}
+
+    # Strings stay as object arrays, everything else as float arrays
+    inputs = {name: _to_float(columns[name]) for name in NUMERIC_COLUMNS}
+    for name, default in DEFAULTS.items():
+        inputs[name] = np.asarray(columns[name]).astype(str) if name in columns else np.full(size, default)
+
+    N = _to_float(columns['N']) if 'N' in columns else np.full(size, float(steps))
+    errors = _row_errors(inputs, N)
+
+    # The engine shares N across a batch, so contracts with their own N are priced per distinct value
+    valid = errors == ''
+    for n in np.unique(N[valid]):
+        rows = np.flatnonzero(valid & (N == n))
+        try:
+            _price_rows(inputs, rows, int(n), greeks, names, out)
+        except Exception:
+            # Price the rows one by one, so that only the ones that fail are flagged
+            for row in rows:
+                try:
+                    _price_rows(inputs, np.array([row]), int(n), greeks, names, out)
+                except Exception as error:
+                    errors[row] = f'{type(error).__name__}: {error}'
+
+    out[ERROR_COLUMN] = errors
+    return out
+
+# Price the contracts at `rows` with N steps, writing the results into `out`
+def _price_rows(inputs: Dict[str, np.ndarray], rows, N: int, greeks: bool, names: List[str], out: Dict[str, np.ndarray]) -> None:
+    batch = {name: value[rows] for name, value in inputs.items()}
+    result = binomial_tree_batch(N = N, greeks = greeks, **batch)
+    for name in names:
+        out[name][rows] = result[name]
+
+# Read a CSV file as chunks of {column name: array}, with every cell kept as the original string
+def read_csv_chunks(path: str, chunk_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    with open(path, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+            yield dict(zip(header, (np.array(col, dtype = object) for col in zip(*rows))))
+
+# Read a Parquet file as chunks of {column name: array}. Needs pyarrow.
+def read_parquet_chunks(path: str, chunk_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size = chunk_size):
+        yield {name: batch.column(name).to_numpy(zero_copy_only = False) for name in batch.schema.names}
+
+# Write chunks of {column name: array} to a CSV file as they arrive
+class CsvWriter:
+    def __init__(self, path: str):
+        self.file = open(path, 'w', newline = '')
+        self.writer = csv.writer(self.file)
+        self.header = None
+
+    def write(self, columns: Dict[str, np.ndarray]) -> None:
+        if self.header is None:
+            self.header = list(columns)
+            self.writer.writerow(self.header)
+        self.writer.writerows(zip(*(columns[name].tolist() for name in self.header)))
+
+    def close(self) -> None:
+        self.file.close()
+
+# Write chunks of {column name: array} to a Parquet file as they arrive. Needs pyarrow.
+class ParquetWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+
+    def write(self, columns: Dict[str, np.ndarray]) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table({name: np.asarray(col) for name, col in columns.items()})
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+def _is_parquet(path: str) -> bool:
+    return path.lower().endswith(('.parquet', '.pq'))
+
+def run(input_path: str, output_path: str, steps: int = 100, chunk_size: int = 50000, workers: int = 1, greeks: bool = False, progress: bool = False) -> float:
+    '''
+    Prices every contract in `input_path` and writes the input columns plus the results to `output_path`.
+
+    At most 2 * workers chunks are in flight at any time and results are written in input order as soon as the
+    oldest chunk is done, so memory stays flat however large the file is.
+
+    Returns:
+        - throughput (float): Rows priced per second.
+    '''
+    reader = read_parquet_chunks if _is_parquet(input_path) else read_csv_chunks
+    writer = ParquetWriter(output_path) if _is_parquet(output_path) else CsvWriter(output_path)
+
+    start = time.perf_counter()
+    rows = 0
+    pending = deque()
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+
+    # Write out the oldest chunk once it is priced
+    def flush_one() -> None:
+        nonlocal rows
+        columns, future = pending.popleft()
+        columns.update(future.result() if pool else future)
+        writer.write(columns)
+        rows += len(columns['S0'])
+        if progress:
+            elapsed = time.perf_counter() - start
+            print(f'{rows} rows, {rows / elapsed:,.0f} rows/s', file = sys.stderr)
+
+    try:
+        for columns in reader(input_path, chunk_size):
+            missing = [name for name in NUMERIC_COLUMNS if name not in columns]
+            if missing:
+                raise SystemExit(f'{input_path}: missing column(s) {", ".join(missing)}')
+
+            work = {name: columns[name] for name in NUMERIC_COLUMNS + ['N', 'opt_type', 'deriv_type'] if name in columns}
+            if pool:
+                pending.append((columns, pool.submit(price_chunk, work, steps, greeks)))
+            else:
+                pending.append((columns, price_chunk(work, steps, greeks)))
+
+            while len(pending) >= 2 * max(workers, 1):
+                flush_one()
+
+        while pending:
+            flush_one()
+    finally:
+        writer.close()
+        if pool:
+            pool.shutdown(cancel_futures = True)
+
+    elapsed = time.perf_counter() - start
+    throughput = rows / elapsed if elapsed > 0 else float('inf')
+    print(f'Priced {rows} rows in {elapsed:.2f} s ({throughput:,.0f} rows/s)', file = sys.stderr)
+    return throughput
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Price option contracts in bulk with the Binomial Options Pricing Model.')
+    parser.add_argument('input', help = 'CSV or Parquet file with columns S0, K, T, r, v and optionally opt_type, deriv_type, N')
+    parser.add_argument('output', help = 'CSV or Parquet file to write (input columns plus price, u, d, p)')
+    parser.add_argument('--steps', type = int, default = 100, help = 'number of time steps N for rows without an N column (default: 100)')
+    parser.add_argument('--chunk-size', type = int, default = 50000, help = 'rows priced per chunk (default: 50000)')
+    parser.add_argument('--workers', type = int, default = 1, help = 'worker processes (default: 1, i.e. price in this process)')
+    parser.add_argument('--greeks', action = 'store_true', help = 'also write delta, gamma, theta, vega and rho')
+    parser.add_argument('--progress', action = 'store_true', help = 'report running throughput after each chunk')
+    args = parser.parse_args(argv)
+
+    run(args.input, args.output, args.steps, args.chunk_size, args.workers, args.greeks, args.progress)
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,1175 @@
-from typing import Dict, List, Tuple
-import numpy as np
-
-# Get the up, down, up probability, and the full dictionary of prices and payoffs for each node
-def binomial_tree(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European') -> Tuple[float, float, float, Dict[int, List[float]]]:
-    '''
-    Calculates the price of a European or American option using the Binomial Options Pricing Model.
-
-    Parameters:
-    - S0 (float): Initial stock price
-    - K (float): Strike price
-    - T (float): Time to maturity in years
-    - N (int): Number of time steps
-    - r (float): Annual discount rate (Continuous compounding)
-    - v (float): Annual stock volatility
-    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
-    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
-
-    Returns:
-        - u (float): The up rate of the stock price, rounded to 4 decimal places.
-        - d (float): The down rate of the stock price, rounded to 4 decimal places.
-        - p (float): The probability of the up rate, rounded to 4 decimal places.
-        - pp_dict (Dict{int: List[float]}): The node number as the key, with each price and payoff amount for each node in the binomial tree.
-    '''
-    # Pre-compute constants
-    dt = T/N
-    
-    u = np.exp(v * np.sqrt(dt))
-    d = np.exp(-v * np.sqrt(dt))
-    p = (np.exp(r * dt) - d) / (u - d)
-
-    disc = np.exp(-r * dt)
-
-    # Initialise empty NumPy arrays to keep track of all prices and payoffs
-    prices = np.array([])
-    payoffs = np.array([]) 
-    
-    # Initialise asset prices at maturity - Time step N
-    Pr = S0 * d ** (np.arange(N, -1, -1)) * u ** (np.arange(0, N+1, 1))
-
-    # Initialise option values at maturity
-    if opt_type == 'Call':
-        Pa = np.maximum(Pr - K, np.zeros(N+1))
-    else:
-        Pa = np.maximum(K - Pr, np.zeros(N+1))
-
-    prices = np.concatenate((prices, Pr))
-    payoffs = np.concatenate((payoffs, Pa))
-    
-    # Step backwards through tree
-    for i in np.arange(N-1, -1, -1):
-        Pr = S0 * d ** (np.arange(i, -1, -1)) * u ** (np.arange(0, i+1, 1))
-        Pa[:i+1] = disc * (p * Pa[1:i+2] + (1 - p) * Pa[0:i+1])
-        Pa = Pa[:-1]
-
-        if deriv_type == 'American':
-            if opt_type == 'Call':
-                Pa = np.maximum(Pa, Pr - K)
-            else:
-                Pa = np.maximum(Pa, K - Pr)
-    
-        prices = np.concatenate((prices, Pr))
-        payoffs = np.concatenate((payoffs, Pa))
-
-    pp_list = [[a, b] for a, b in zip(prices, payoffs)]
-    pp_dict = {i: pp_list[prices.size - i] for i in np.arange(prices.size, 0, -1).tolist()}
-
-    return u, d, p, pp_dict
-
-# Generate the pairs of linked nodes
-def generate_step_pairs(steps: int) -> List[List[int]]:
-    result = {}
-    current_number = 1
-    for i in range(steps):
-        row_numbers = [num for num in range(current_number, current_number + i + 1)]
-        result[i] = row_numbers
-        current_number += (i + 1)
-
-    pairs = []
-    for k, v in result.items():
-        for i in v:
-            pairs.append([i, i + k + 1])
-            pairs.append([i, i + k + 2])
-    
-    return pairs
-
-# Get final pairs as full string to be displayed in graphviz chart
-def final_pairs_str(pp_dict: Dict[int, List[float]], all_pairs: List[List[int]]) -> str:
-    pp_string = {i: f'"Price {i}: {np.round(pp_dict[i][0], 4)}\lPayoff {i}: {np.round(pp_dict[i][1], 4)}\l"' for i in pp_dict}
-    return ''.join([f'{pp_string[a]} -> {pp_string[b]}' for a, b in all_pairs])
+from collections.abc import Mapping
+from operator import index as as_index
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+
+# Triangular store of the prices and payoffs at every node of a binomial tree
+class Lattice:
+    '''
+    Prices and payoffs of an N-step binomial tree, held in two contiguous float64 arrays.
+
+    Nodes are stored level by level from time step 0 to N, and within a level from the highest stock price (most up
+    moves) to the lowest. Node numbers therefore run 1, 2, 3, ... in the same order as the graph and the Excel
+    export, and node number n lives at flat index n - 1.
+
+    Attributes:
+    - N (int): Number of time steps
+    - prices (np.ndarray): Stock price at each node
+    - payoffs (np.ndarray): Option value at each node
+    '''
+    __slots__ = ('N', 'prices', 'payoffs')
+
+    def __init__(self, N: int, prices: np.ndarray, payoffs: np.ndarray):
+        self.N = N
+        self.prices = prices
+        self.payoffs = payoffs
+
+    def __len__(self) -> int:
+        return self.prices.size
+
+    def __repr__(self) -> str:
+        return f'Lattice(N={self.N}, nodes={len(self)})'
+
+    @property
+    def nbytes(self) -> int:
+        return self.prices.nbytes + self.payoffs.nbytes
+
+    # Get the flat index of the node reached after `step` steps with `j` up moves
+    @staticmethod
+    def index(step: int, j: int) -> int:
+        return step * (step + 1) // 2 + step - j
+
+    # Get the (step, j) position of a node number
+    @staticmethod
+    def position(node: int) -> Tuple[int, int]:
+        k = node - 1
+        step = int((np.sqrt(8 * k + 1) - 1) // 2)
+        if step * (step + 1) // 2 > k:
+            step -= 1
+        elif (step + 1) * (step + 2) // 2 <= k:
+            step += 1
+        return step, step - (k - step * (step + 1) // 2)
+
+    # Get the price and payoff of a node number
+    def node(self, node: int) -> Tuple[float, float]:
+        k = as_index(node) - 1
+        if not 0 <= k < self.prices.size:
+            raise IndexError(f'node {node} is not in a tree with {self.N} steps')
+        return self.prices[k], self.payoffs[k]
+
+    # Get the price and payoff of the node reached after `step` steps with `j` up moves
+    def at(self, step: int, j: int) -> Tuple[float, float]:
+        if not 0 <= j <= step <= self.N:
+            raise IndexError(f'({step}, {j}) is not in a tree with {self.N} steps')
+        k = self.index(step, j)
+        return self.prices[k], self.payoffs[k]
+
+    # Get views of the prices and payoffs at one time step, highest stock price first
+    def level(self, step: int) -> Tuple[np.ndarray, np.ndarray]:
+        if not 0 <= step <= self.N:
+            raise IndexError(f'step {step} is not in a tree with {self.N} steps')
+        start = step * (step + 1) // 2
+        return self.prices[start:start+step+1], self.payoffs[start:start+step+1]
+
+    # Read-only {node number: [price, payoff]} view, for code written against the old pp_dict
+    @property
+    def nodes(self) -> 'LatticeNodes':
+        return LatticeNodes(self)
+
+# Read-only mapping of node numbers to (price, payoff) pairs, backed by a Lattice
+class LatticeNodes(Mapping):
+    __slots__ = ('lattice',)
+
+    def __init__(self, lattice: Lattice):
+        self.lattice = lattice
+
+    def __getitem__(self, node: int) -> Tuple[float, float]:
+        try:
+            return self.lattice.node(node)
+        except (IndexError, TypeError):
+            raise KeyError(node) from None
+
+    def __contains__(self, node) -> bool:
+        try:
+            return 1 <= as_index(node) <= len(self.lattice)
+        except TypeError:
+            return False
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(1, len(self.lattice) + 1))
+
+    def __len__(self) -> int:
+        return len(self.lattice)
+
+    @property
+    def nbytes(self) -> int:
+        return self.lattice.nbytes
+
+# Get the up, down, up probability, and the full lattice of prices and payoffs for each node
+def binomial_lattice(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European', model: str = 'crr') -> Tuple[float, float, float, Lattice]:
+    '''
+    Calculates the price of a European or American option using the Binomial Options Pricing Model, keeping the
+    price and payoff at every node.
+
+    Parameters:
+    - S0 (float): Initial stock price
+    - K (float): Strike price
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - v (float): Annual stock volatility
+    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
+    - model (str, optional): Lattice parameterization, one of the binomial MODELS ('crr', 'jr', 'tian' or 'lr'). Defaults to 'crr'.
+
+    Returns:
+        - u (float): The up rate of the stock price.
+        - d (float): The down rate of the stock price.
+        - p (float): The probability of the up rate.
+        - lattice (Lattice): The price and payoff amount for each node in the binomial tree.
+    '''
+    if model == 'trinomial':
+        raise ValueError("the full lattice is binomial, use binomial_price or binomial_tree_batch for model='trinomial'")
+
+    # Pre-compute constants
+    N = _model_steps(N, model)
+    u, d, (q, p), disc = _lattice_params(S0, K, T, N, r, v, model)
+
+    # Preallocate the whole triangle, (N+1)(N+2)/2 nodes
+    prices = np.empty((N + 1) * (N + 2) // 2)
+    payoffs = np.empty_like(prices)
+
+    # Initialise asset prices at maturity - Time step N
+    j = np.arange(0, N+1, 1)
+    Pr = S0 * d ** (N - j) * u ** j
+
+    # Initialise option values at maturity
+    if opt_type == 'Call':
+        Pa = np.maximum(Pr - K, 0)
+    else:
+        Pa = np.maximum(K - Pr, 0)
+
+    # Levels are stored highest price first, hence the reversed copies
+    start = N * (N + 1) // 2
+    prices[start:] = Pr[::-1]
+    payoffs[start:] = Pa[::-1]
+
+    # Step backwards through tree
+    for i in range(N-1, -1, -1):
+        Pr = S0 * d ** (i - j[:i+1]) * u ** j[:i+1]
+        Pa = disc * p * Pa[1:i+2] + disc * q * Pa[0:i+1]
+
+        if deriv_type == 'American':
+            if opt_type == 'Call':
+                Pa = np.maximum(Pa, Pr - K)
+            else:
+                Pa = np.maximum(Pa, K - Pr)
+
+        start = i * (i + 1) // 2
+        prices[start:start+i+1] = Pr[::-1]
+        payoffs[start:start+i+1] = Pa[::-1]
+
+    return u, d, p, Lattice(N, prices, payoffs)
+
+# Get the up, down, up probability, and a dictionary-like view of prices and payoffs for each node
+def binomial_tree(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European', greeks: bool = False, model: str = 'crr') -> Tuple:
+    '''
+    Calculates the price of a European or American option using the Binomial Options Pricing Model.
+
+    Parameters:
+    - S0 (float): Initial stock price
+    - K (float): Strike price
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - v (float): Annual stock volatility
+    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
+    - greeks (bool, optional): Also return the Greeks. Defaults to False.
+    - model (str, optional): Lattice parameterization, one of the binomial MODELS ('crr', 'jr', 'tian' or 'lr'). Defaults to 'crr'.
+
+    Returns:
+        - u (float): The up rate of the stock price, rounded to 4 decimal places.
+        - d (float): The down rate of the stock price, rounded to 4 decimal places.
+        - p (float): The probability of the up rate, rounded to 4 decimal places.
+        - pp_dict (LatticeNodes): Read-only mapping with the node number as the key, and the price and payoff amount for each node in the binomial tree as the value. The underlying Lattice is available as pp_dict.lattice.
+        - greeks (Dict[str, float]): Only if greeks is True. Delta, gamma and theta (per year) read off the nodes at time steps 1 and 2, and vega and rho (per unit of v and r) from one bumped pass.
+    '''
+    u, d, p, lattice = binomial_lattice(S0, K, T, N, r, v, opt_type, deriv_type, model)
+
+    if not greeks:
+        return u, d, p, lattice.nodes
+
+    # Levels are stored highest price first, the Greeks expect lowest first
+    N = lattice.N
+    V1 = lattice.level(1)[1][::-1]
+    V2 = lattice.level(2)[1][::-1] if N >= 2 else None
+    values = _lattice_greeks(S0, u, d, T/N, lattice.payoffs[0], V1, V2)
+    values.update(_bumped_greeks(S0, K, T, N, r, v, opt_type == 'Call', deriv_type == 'American', model))
+
+    return u, d, p, lattice.nodes, {name: float(value) for name, value in values.items()}
+
+# Get u, d, p and the prices and payoffs at a few time steps only, without building the full lattice
+def lattice_levels(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European', steps = None, model: str = 'crr') -> Tuple:
+    '''
+    Calculates the prices and payoffs at the chosen time steps of a binomial tree. Only those levels are kept, so
+    memory is O(N) per level rather than the O(N^2) of binomial_lattice.
+
+    Parameters:
+    - S0 (float): Initial stock price
+    - K (float): Strike price
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - v (float): Annual stock volatility
+    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
+    - steps (Iterable[int], optional): Time steps to keep. Defaults to every step.
+    - model (str, optional): Lattice parameterization, one of the binomial MODELS ('crr', 'jr', 'tian' or 'lr'). Defaults to 'crr'.
+
+    Returns:
+        - u (float): The up rate of the stock price.
+        - d (float): The down rate of the stock price.
+        - p (float): The probability of the up rate.
+        - levels (Dict[int, Tuple[np.ndarray, np.ndarray]]): The prices and payoffs at each kept time step, highest price first like Lattice.level.
+    '''
+    if model == 'trinomial':
+        raise ValueError("the levels are binomial, use binomial_price or binomial_tree_batch for model='trinomial'")
+
+    N = _model_steps(N, model)
+    steps = range(N + 1) if steps is None else steps
+    u, d, probs, disc = _lattice_params(S0, K, T, N, r, v, model)
+
+    capture = {int(i): None for i in steps}
+    for i in capture:
+        if not 0 <= i <= N:
+            raise IndexError(f'step {i} is not in a tree with {N} steps')
+
+    # The edges of each level are drawn, so they must not be truncated
+    _backward_induction(S0, K, N, u, d, probs, disc, opt_type == 'Call', deriv_type == 'American', capture, truncate = False)
+
+    levels = {}
+    for i, payoffs in sorted(capture.items()):
+        j = np.arange(i, -1, -1)
+        levels[i] = (S0 * d ** (i - j) * u ** j, payoffs[::-1])
+
+    return float(u), float(d), float(probs[-1]), levels
+
+# Get the up rate, down rate, up probability and one-step discount factor of a CRR lattice
+def _crr_params(T, N: int, r, v) -> Tuple:
+    dt = T/N
+
+    u = np.exp(v * np.sqrt(dt))
+    d = np.exp(-v * np.sqrt(dt))
+    p = (np.exp(r * dt) - d) / (u - d)
+
+    disc = np.exp(-r * dt)
+
+    return u, d, p, disc
+
+# Lattice parameterizations accepted by the pricing functions
+MODELS = ('crr', 'jr', 'tian', 'lr', 'trinomial')
+
+# Peizer-Pratt (method 2) inversion of the normal distribution, used by Leisen-Reimer
+def _peizer_pratt(z, n: int) -> np.ndarray:
+    return 0.5 + np.sign(z) * 0.5 * np.sqrt(1 - np.exp(-(z / (n + 1/3 + 0.1 / (n + 1))) ** 2 * (n + 1/6)))
+
+# Leisen-Reimer needs an odd number of steps
+def _model_steps(N: int, model: str) -> int:
+    return N + 1 if model == 'lr' and N % 2 == 0 else N
+
+def _lattice_params(S0, K, T, N: int, r, v, model: str = 'crr') -> Tuple:
+    '''
+    Gets the up rate, down rate, branch probabilities (lowest price first) and one-step discount factor of a lattice.
+
+    - 'crr': Cox-Ross-Rubinstein, u = exp(v * sqrt(dt)) and d = 1/u.
+    - 'jr': Jarrow-Rudd, equal probabilities with the drift in u and d.
+    - 'tian': Tian, matching the first three moments of the stock price.
+    - 'lr': Leisen-Reimer, centred on the strike for second-order convergence without odd/even oscillation (N odd).
+    - 'trinomial': Three branches with u = exp(v * sqrt(2 dt)) and d = 1/u, and a middle branch that stays put.
+    '''
+    if model not in MODELS:
+        raise ValueError(f'model must be one of {MODELS}, not {model!r}')
+
+    dt = T/N
+    growth = np.exp(r * dt)
+    disc = np.exp(-r * dt)
+
+    if model == 'crr':
+        u, d, p, _ = _crr_params(T, N, r, v)
+    elif model == 'jr':
+        drift = (r - v * v / 2) * dt
+        u = np.exp(drift + v * np.sqrt(dt))
+        d = np.exp(drift - v * np.sqrt(dt))
+        p = np.full(np.shape(u), 0.5)
+    elif model == 'tian':
+        V = np.exp(v * v * dt)
+        root = np.sqrt(V * V + 2 * V - 3)
+        u = growth * V / 2 * (V + 1 + root)
+        d = growth * V / 2 * (V + 1 - root)
+        p = (growth - d) / (u - d)
+    elif model == 'lr':
+        with np.errstate(divide = 'ignore'):
+            d1 = (np.log(S0 / K) + (r + v * v / 2) * T) / (v * np.sqrt(T))
+        d2 = d1 - v * np.sqrt(T)
+        p = _peizer_pratt(d2, N)
+        u = growth * _peizer_pratt(d1, N) / p
+        d = (growth - p * u) / (1 - p)
+    else:
+        x = v * np.sqrt(dt / 2)
+        half = np.exp(r * dt / 2)
+        p_up = ((half - np.exp(-x)) / (np.exp(x) - np.exp(-x))) ** 2
+        p_down = ((np.exp(x) - half) / (np.exp(x) - np.exp(-x))) ** 2
+        u = np.exp(v * np.sqrt(2 * dt))
+        return u, 1 / u, (p_down, 1 - p_up - p_down, p_up), disc
+
+    return u, d, (1 - p, p), disc
+
+# Number of standard deviations of the root's terminal distribution kept at each level of large trees
+TRUNCATE_SD = 8.0
+
+# Roll option values back from maturity to the root, updating preallocated buffers in place
+def _backward_induction(S0, K, N: int, u, d, probs: Tuple, disc, is_call, is_american, capture: Dict[int, np.ndarray] = None, bs_step: Tuple = None, truncate: bool = True, stop: int = 0) -> np.ndarray:
+    '''
+    Shared backward-induction kernel for binomial and trinomial lattices. Every argument except N may be a scalar or
+    an array of contracts, and the tree levels run down the first axis of the working buffers. Memory is O(N) per
+    contract and nothing is allocated inside the time-step loop.
+
+    `probs` holds the branch probabilities, lowest price first: (1-p, p) for a binomial lattice or
+    (p_down, p_middle, p_up) for a trinomial one.
+
+    Once a level is wider than TRUNCATE_SD standard deviations of the terminal distribution, only the nodes inside
+    that window are updated, so large trees cost O(N^1.5) instead of O(N^2). The window covers both the risk-neutral
+    distribution (which bounds what put nodes add to the root value) and the share-measure distribution (which
+    bounds what call nodes add), so the nodes left out change the root value by about S0 or K times the normal tail
+    beyond TRUNCATE_SD, i.e. around 1e-15 relative. Captured levels are only exact inside the window, so pass
+    truncate=False when the values at the edges of a level are needed.
+
+    If `capture` is given, a copy of the option values at each time step in its keys is stored under that key
+    (lowest stock price first), e.g. {1: None, 2: None} for the Greeks.
+
+    If `bs_step` is given as (r, v, dt), the option values at step N-1 are the closed-form Black-Scholes values over
+    the last step instead of the discounted payoffs (the Binomial Black-Scholes method), which removes most of the
+    odd/even oscillation of the plain tree.
+
+    If `stop` is given, the induction ends at that time step instead of the root, and the window covers everything
+    reachable from any node of that level (see spot_vol_surface). Capture the level to read it.
+
+    Returns:
+        - price (np.ndarray): The option value at the root node for each contract (the lowest node of step `stop`).
+    '''
+    # Branch weights with discounting folded in
+    weights = [disc * q for q in probs]
+    branches = len(probs)
+
+    # A trinomial step moves up to two node spacings, i.e. it spans two binomial half-steps of sqrt(u) and sqrt(d).
+    # Level i then has `width * i + 1` nodes.
+    width = branches - 1
+    if branches == 3:
+        u, d = np.sqrt(u), np.sqrt(d)
+
+    # +1 for calls and -1 for puts, so that the payoff is always max(sign * (S - K), 0)
+    sign = np.where(is_call, 1.0, -1.0)
+    sign_K = sign * K
+    early = np.asarray(is_american)
+    any_american = early.any()
+
+    # Exercise values of European contracts in a mixed batch are pushed to -inf, so they never win the max. Folding
+    # that into the strike saves a pass over the level.
+    exercise_floor = np.where(early, 0.0, -np.inf)
+    exercise_K = sign_K - exercise_floor
+
+    # Asset prices at level i are S0 * u**c * d**(width*i-c) * (u/d)**(j-c). Keep the ratios (centred on c to avoid
+    # overflow) and one scale per level, so node prices cost one multiplication rather than two powers.
+    L = width * N
+    c = L // 2
+    # Contracts may share one lattice (scalar u and d) while their strikes, types or styles differ
+    contracts = np.broadcast(S0, K, u, d, weights[0], is_call, is_american)
+    j = np.arange(0, L+1, 1).reshape((-1,) + (1,) * contracts.ndim)
+    R = u ** (j - c) * d ** (c - j)
+    base = sign * S0 * u ** c
+    scale = np.array(base * d ** (L - c), dtype = float)
+
+    if bs_step is None:
+        # Initialise option values at maturity - Time step N
+        Pa = np.maximum(scale * R - sign_K, 0)
+        first = N - 1
+    else:
+        # Initialise option values one step before maturity from the closed form
+        r, v, dt = bs_step
+        top = width * (N - 1) + 1
+        S = S0 * u ** c * d ** (top - 1 - c) * R[:top]
+        Pa = np.zeros(np.broadcast(R, scale, sign_K).shape)
+        Pa[:top] = _black_scholes(S, K, dt, r, v, sign)
+        if any_american:
+            Pa[:top] = np.maximum(Pa[:top], sign * (S - K) + exercise_floor)
+        first = N - 2
+    tmp = np.empty_like(Pa)
+    tmp_up = np.empty_like(Pa) if branches == 3 else None
+
+    if capture is not None and first + 1 in capture:
+        capture[first + 1] = Pa[:width*(first+1)+1].copy()
+
+    # Window of nodes that carry non-negligible value, from the mean and variance of one step in node spacings. Put
+    # values are bounded by K, so the risk-neutral probabilities decide which nodes matter. Call values grow with S,
+    # and a node's share of the root value is its probability under the share measure (probabilities weighted by
+    # the discounted price move), which drifts up by about v * sqrt(T) * sqrt(N) / 2 nodes. Keep both windows.
+    moves = [u ** k * d ** (width - k) for k in range(branches)]
+    share = [w * m for w, m in zip(weights, moves)]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        share_total = sum(share)
+        means, variances = [], []
+        for q in (probs, [s / share_total for s in share]):
+            mean = sum(k * q_k for k, q_k in enumerate(q))
+            means.append(np.asarray(mean))
+            variances.append(np.asarray(sum(k * k * q_k for k, q_k in enumerate(q)) - mean ** 2))
+
+    # Probabilities outside [0, 1] (a volatility below r * sqrt(dt)) or a zero volatility have no meaningful
+    # distribution to cut, so those lattices are rolled back in full
+    stats = means + variances
+    bounded = all(np.isfinite(x).all() for x in stats) and all((x >= 0).all() for x in variances)
+    if truncate and bounded:
+        half_width = int(np.ceil(TRUNCATE_SD * np.sqrt((N - stop) * max(np.max(x) for x in variances)))) + 1
+        mean_lo = float(min(np.min(x) for x in means))
+        mean_hi = float(max(np.max(x) for x in means))
+    else:
+        half_width = L + 1
+        mean_lo, mean_hi = 0.0, float(width)
+
+    # Step backwards through tree
+    for i in range(first, stop - 1, -1):
+        lo = max(0, int((i - stop) * mean_lo) - half_width)
+        hi = min(width * i, int((i - stop) * mean_hi) + width * stop + half_width + 1) + 1
+
+        # Gather the higher branches before the lowest one overwrites the level in place
+        np.multiply(Pa[lo+1:hi+1], weights[1], out = tmp[lo:hi])
+        if branches == 3:
+            np.multiply(Pa[lo+2:hi+2], weights[2], out = tmp_up[lo:hi])
+            np.add(tmp[lo:hi], tmp_up[lo:hi], out = tmp[lo:hi])
+        np.multiply(Pa[lo:hi], weights[0], out = Pa[lo:hi])
+        np.add(Pa[lo:hi], tmp[lo:hi], out = Pa[lo:hi])
+
+        if any_american:
+            np.power(d, width * i - c, out = scale)
+            np.multiply(scale, base, out = scale)
+            np.multiply(R[lo:hi], scale, out = tmp[lo:hi])
+            np.subtract(tmp[lo:hi], exercise_K, out = tmp[lo:hi])
+            np.maximum(Pa[lo:hi], tmp[lo:hi], out = Pa[lo:hi])
+
+        if capture is not None and i in capture:
+            capture[i] = Pa[:width*i+1].copy()
+
+    return Pa[0]
+
+# Convergence accelerators accepted by binomial_price and binomial_tree_batch
+METHODS = ('crr', 'richardson', 'bbs', 'bbsr', 'analytic')
+
+# Price contracts with one of the METHODS, returning the price and an error estimate
+def _accelerated_price(S0, K, T, N: int, r, v, is_call, is_american, method: str = 'crr', capture: Dict[int, np.ndarray] = None, model: str = 'crr') -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    - 'crr': the plain tree of the chosen model. No error estimate (NaN).
+    - 'richardson': Richardson extrapolation of P(N) and P(N/2), cancelling the leading 1/N^2 error term of the
+      Leisen-Reimer tree. Only offered with model 'lr': the other plain trees oscillate with N and with where the
+      strike falls between nodes, and extrapolating them is less accurate than the tree itself.
+    - 'bbs': Binomial Black-Scholes, with the closed-form value at step N-1.
+    - 'bbsr': Richardson extrapolation of BBS.
+    - 'analytic': Black-Scholes for European contracts (error 0) and 'bbsr' for American ones.
+
+    Apart from 'crr' and European 'analytic', the error estimate is |P(N) - P(N/2)| of the underlying tree. It is the
+    size of the correction, not a bound: it roughly matches the error of 'bbs', and is usually (not always) larger
+    than the error of the extrapolated methods.
+    '''
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}, not {method!r}')
+    if method == 'richardson' and model != 'lr':
+        raise ValueError(f"method 'richardson' needs model 'lr', the {model!r} tree does not converge smoothly. Use method 'bbsr' instead.")
+
+    shape = np.broadcast(S0, K, T, r, v, is_call, is_american).shape
+
+    if method == 'crr':
+        u, d, probs, disc = _lattice_params(S0, K, T, N, r, v, model)
+        price = _backward_induction(S0, K, N, u, d, probs, disc, is_call, is_american, capture)
+        return price, np.full(shape, np.nan)
+
+    if N < 2:
+        raise ValueError(f'method {method!r} needs N >= 2')
+
+    if method == 'analytic':
+        S0, K, T, r, v, is_call, is_american = (np.broadcast_to(x, shape) for x in (S0, K, T, r, v, is_call, is_american))
+        price = _black_scholes(S0, K, T, r, v, np.where(is_call, 1.0, -1.0))
+        error = np.zeros(shape)
+
+        # Only American contracts need a tree
+        idx = np.flatnonzero(is_american.ravel())
+        if idx.size:
+            sub = lambda x: x.ravel()[idx]
+            price_am, error_am = _accelerated_price(*(sub(x) for x in (S0, K, T)), N, sub(r), sub(v), sub(is_call), True, 'bbsr', capture, model)
+            price = price.ravel().copy()
+            error = error.ravel()
+            price[idx] = price_am
+            error[idx] = error_am
+
+        return price.reshape(shape), error.reshape(shape)
+
+    # Every other method compares the tree with N steps against one with about N/2 steps
+    smooth = method in ('bbs', 'bbsr')
+    steps = (N, _model_steps(N // 2, model))
+    prices = []
+    for n, levels in zip(steps, (capture, None)):
+        u, d, probs, disc = _lattice_params(S0, K, T, n, r, v, model)
+        bs_step = (r, v, T/n) if smooth else None
+        prices.append(_backward_induction(S0, K, n, u, d, probs, disc, is_call, is_american, levels, bs_step))
+
+    full, half = prices
+    error = np.abs(full - half)
+    if method == 'bbs':
+        return full, error
+
+    # Weight the two trees so that the leading error term, proportional to 1/n**order, cancels
+    order = 1 if smooth else 2
+    a, b = steps[0] ** order, steps[1] ** order
+    price = (a * full - b * half) / (a - b)
+
+    return price, error
+
+# Get only the price of an option, without building the full lattice
+def binomial_price(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European', method: str = 'crr', model: str = 'crr') -> float:
+    '''
+    Calculates the price of a European or American option using the Binomial Options Pricing Model, keeping only a
+    single level of the tree in memory. Suitable for very large N (e.g. 100,000 steps).
+
+    Parameters:
+    - S0 (float): Initial stock price
+    - K (float): Strike price
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - v (float): Annual stock volatility
+    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
+    - method (str, optional): Convergence accelerator, one of METHODS ('crr', 'richardson', 'bbs', 'bbsr' or 'analytic'). Defaults to 'crr', the plain tree. 'richardson' needs model 'lr'. Use binomial_tree_batch for the error estimates.
+    - model (str, optional): Lattice parameterization, one of MODELS ('crr', 'jr', 'tian', 'lr' or 'trinomial'). Defaults to 'crr'.
+
+    Returns:
+        - price (float): The option value at time step 0.
+    '''
+    N = _model_steps(N, model)
+    price, _ = _accelerated_price(S0, K, T, N, r, v, opt_type == 'Call', deriv_type == 'American', method, model = model)
+    return float(price)
+
+# Price many (strike, type, style) variants of one underlying from a single shared lattice
+def binomial_variants(S0: float, K, T: float, N: int, r: float, v: float, opt_types = ('Call', 'Put'), model: str = 'crr') -> np.ndarray:
+    '''
+    Calculates European and American prices of every strike and option type on one underlying in a single backward
+    induction. The stock price lattice depends only on S0, u, d and N, so it is shared and all the variants are rolled
+    back together as columns of one 2D array, for roughly the cost of one tree.
+
+    Parameters:
+    - S0 (float): Initial stock price
+    - K (array_like): Strike prices (e.g. a strike ladder)
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - v (float): Annual stock volatility
+    - opt_types (Sequence[str], optional): Option types to price ('Call' and/or 'Put'). Defaults to both.
+    - model (str, optional): Lattice parameterization, one of MODELS ('crr', 'jr', 'tian', 'lr' or 'trinomial'). Defaults to 'crr'. Leisen-Reimer centres its lattice on the strike, so with 'lr' each strike gets its own u and d (still in the same pass).
+
+    Returns:
+        - result (np.ndarray): Structured array of shape np.shape(K) + (len(opt_types),) with the fields 'european' and 'american' (the prices) and 'premium' (the early-exercise premium, american - european).
+    '''
+    K = np.asarray(K, dtype = float)
+    opt_types = np.asarray(opt_types)
+    shape = K.shape + opt_types.shape
+
+    # One column per (strike, type, style), with the two styles of each contract next to each other
+    strikes = np.repeat(np.broadcast_to(K.reshape(K.shape + (1,) * opt_types.ndim), shape).ravel(), 2)
+    is_call = np.repeat(np.broadcast_to(opt_types == 'Call', shape).ravel(), 2)
+    is_american = np.tile([False, True], strikes.size // 2)
+
+    N = _model_steps(N, model)
+    u, d, probs, disc = _lattice_params(S0, strikes if model == 'lr' else K.flat[0] if K.size else 1.0, T, N, r, v, model)
+    price = _backward_induction(S0, strikes, N, u, d, probs, disc, is_call, is_american).reshape(-1, 2)
+
+    result = np.empty(shape, dtype = [('european', float), ('american', float), ('premium', float)])
+    result['european'] = price[:, 0].reshape(shape)
+    result['american'] = price[:, 1].reshape(shape)
+    result['premium'] = result['american'] - result['european']
+
+    return result
+
+# Price a grid of spots and volatilities from one extended lattice
+def spot_vol_surface(S0: float, K: float, T: float, N: int, r: float, spots, vols, opt_type: str = 'Call', deriv_type: str = 'European', model: str = 'crr') -> np.ndarray:
+    '''
+    Calculates the price and delta of an option for every spot in a ladder (e.g. S0 * np.linspace(0.8, 1.2, 41)) and
+    every volatility in a grid, in a single backward pass.
+
+    The tree is extended by E steps on the past side, so that the nodes at step E span the whole ladder and each of
+    them is the root of an ordinary N-step tree. The induction stops at step E, and the prices (and the deltas from
+    step E + 1) are interpolated to the requested spots with cubic Hermite splines. Every volatility is a column of
+    the same pass. A spot that falls on a node (such as S0 for 'crr') gets exactly the price of binomial_price.
+    Leisen-Reimer centres its lattice on the strike for S0 only, so away from S0 it is no more accurate than CRR.
+
+    Parameters:
+    - S0 (float): Initial stock price, the centre of the extended lattice
+    - K (float): Strike price
+    - T (float): Time to maturity in years
+    - N (int): Number of time steps to maturity (rounded up to the next odd number for 'lr')
+    - r (float): Annual discount rate (Continuous compounding)
+    - spots (array_like): Stock prices to price at
+    - vols (array_like): Annual stock volatilities to price at
+    - opt_type (str, optional): Option type ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (str, optional): Derivative type ('European' or 'American'). Defaults to 'European'.
+    - model (str, optional): Lattice parameterization, one of MODELS ('crr', 'jr', 'tian', 'lr' or 'trinomial'). Defaults to 'crr'.
+
+    Returns:
+        - result (np.ndarray): Structured array of shape np.shape(spots) + np.shape(vols) with the fields 'price' and 'delta'.
+    '''
+    spots = np.asarray(spots, dtype = float)
+    vols = np.asarray(vols, dtype = float)
+    if spots.size == 0 or spots.min() <= 0:
+        raise ValueError('spots must be positive')
+
+    N = _model_steps(N, model)
+    u, d, probs, disc = _lattice_params(S0, K, T, N, r, vols.ravel(), model)
+    width = len(probs) - 1
+
+    # Enough extra steps for step E to reach past both ends of the ladder for every volatility, plus a spare node.
+    # An even E puts a binomial node on S0 itself.
+    reach = np.maximum(np.log(spots.max() / S0) / np.log(u), np.log(spots.min() / S0) / np.log(d))
+    extra = max(int(np.ceil(np.max(reach))), 0) + 1
+    extra += extra % 2 if width == 1 else 0
+
+    levels = {extra: None, extra + 1: None}
+    _backward_induction(S0, K, N + extra, u, d, probs, disc, opt_type == 'Call', deriv_type == 'American', levels, stop = extra)
+    V0, V1 = levels[extra], levels[extra + 1]
+
+    # Stock prices and deltas at the nodes of step E, lowest first, with a column per volatility
+    step_up, step_down = (np.sqrt(u), np.sqrt(d)) if width == 2 else (u, d)
+    k = np.arange(width * extra + 1)[:, None]
+    S = S0 * step_up ** k * step_down ** (width * extra - k)
+    delta = (V1[width:] - V1[:-width]) / (S * (u - d))
+
+    # The nodes are evenly spaced in log price, so the interval of each spot is found in closed form
+    spacing = np.log(step_up / step_down)
+    x = spots.reshape(-1, 1)
+    j = np.clip(np.floor((np.log(x) - np.log(S[0])) / spacing).astype(int), 0, width * extra - 1)
+    take = lambda a, offset: np.take_along_axis(a, j + offset, axis = 0)
+    S_lo, S_hi = take(S, 0), take(S, 1)
+    h = S_hi - S_lo
+    t = (x - S_lo) / h
+
+    # Cubic Hermite interpolation of the prices, using the node deltas as slopes
+    V_lo, V_hi, D_lo, D_hi = take(V0, 0), take(V0, 1), take(delta, 0), take(delta, 1)
+    price = (2*t**3 - 3*t**2 + 1) * V_lo + (t**3 - 2*t**2 + t) * h * D_lo + (-2*t**3 + 3*t**2) * V_hi + (t**3 - t**2) * h * D_hi
+    slope = ((6*t**2 - 6*t) * V_lo + (-6*t**2 + 6*t) * V_hi) / h + (3*t**2 - 4*t + 1) * D_lo + (3*t**2 - 2*t) * D_hi
+
+    result = np.empty(spots.shape + vols.shape, dtype = [('price', float), ('delta', float)])
+    result['price'] = price.reshape(result.shape)
+    result['delta'] = slope.reshape(result.shape)
+
+    return result
+
+# Size of the volatility and rate bumps used for vega and rho
+VEGA_BUMP = 1e-3
+RHO_BUMP = 1e-4
+
+# Get delta, gamma and theta from the option values one and two steps into the tree
+def _lattice_greeks(S0, u, d, dt, V0, V1, V2) -> Dict[str, np.ndarray]:
+    '''
+    V1 and V2 hold the option values at time steps 1 and 2, lowest stock price first (V2 may be None if N < 2).
+    Theta is per year, measured between the root and the middle node at step 2, after moving that node back to S0
+    with delta and gamma (it sits at S0 * u * d, which is only S0 when d = 1/u). A trinomial step already has three
+    nodes, so then only step 1 is used.
+    '''
+    if len(V1) == 3:
+        S_u, S_m, S_d = S0 * u, S0, S0 * d
+        delta = (V1[2] - V1[0]) / (S_u - S_d)
+        gamma = ((V1[2] - V1[1]) / (S_u - S_m) - (V1[1] - V1[0]) / (S_m - S_d)) / ((S_u - S_d) / 2)
+        theta = (V1[1] - V0) / dt
+        return {'delta': delta, 'gamma': gamma, 'theta': theta}
+
+    delta = (V1[1] - V1[0]) / (S0 * u - S0 * d)
+
+    if V2 is None:
+        nan = np.full(np.shape(delta), np.nan)
+        return {'delta': delta, 'gamma': nan, 'theta': nan}
+
+    S_uu, S_ud, S_dd = S0 * u * u, S0 * u * d, S0 * d * d
+    delta_u = (V2[2] - V2[1]) / (S_uu - S_ud)
+    delta_d = (V2[1] - V2[0]) / (S_ud - S_dd)
+    gamma = (delta_u - delta_d) / ((S_uu - S_dd) / 2)
+    shift = S_ud - S0
+    theta = (V2[1] - delta * shift - gamma * shift ** 2 / 2 - V0) / (2 * dt)
+
+    return {'delta': delta, 'gamma': gamma, 'theta': theta}
+
+# Get vega and rho from central differences, with the four bumped trees priced side by side in one pass
+def _bumped_greeks(S0, K, T, N: int, r, v, is_call, is_american, model: str = 'crr') -> Dict[str, np.ndarray]:
+    dv = np.array([VEGA_BUMP, -VEGA_BUMP, 0, 0]).reshape((4,) + (1,) * np.ndim(v))
+    dr = np.array([0, 0, RHO_BUMP, -RHO_BUMP]).reshape(dv.shape)
+
+    u, d, probs, disc = _lattice_params(S0, K, T, N, r + dr, v + dv, model)
+    up_v, down_v, up_r, down_r = _backward_induction(S0, K, N, u, d, probs, disc, is_call, is_american)
+
+    return {'vega': (up_v - down_v) / (2 * VEGA_BUMP), 'rho': (up_r - down_r) / (2 * RHO_BUMP)}
+
+# Price a whole chain of contracts in one pass, with the contracts along the second array axis
+def binomial_tree_batch(S0, K, T, N: int, r, v, opt_type = 'Call', deriv_type = 'European', greeks: bool = False, method: str = 'crr', model: str = 'crr') -> np.ndarray:
+    '''
+    Calculates the prices of many European and/or American options at once using the Binomial Options Pricing Model.
+
+    All contract inputs are broadcast against each other, so any of them may be a scalar or an array. The backward
+    induction runs once per time step for the whole batch instead of once per contract.
+
+    Parameters:
+    - S0 (array_like): Initial stock prices
+    - K (array_like): Strike prices
+    - T (array_like): Times to maturity in years
+    - N (int): Number of time steps (shared by every contract in the batch, rounded up to the next odd number for 'lr')
+    - r (array_like): Annual discount rates (Continuous compounding)
+    - v (array_like): Annual stock volatilities
+    - opt_type (array_like, optional): Option types ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (array_like, optional): Derivative types ('European' or 'American'). Defaults to 'European'.
+    - greeks (bool, optional): Also return delta, gamma and theta read off the tree, and vega and rho from one extra bumped pass. Defaults to False.
+    - method (str, optional): Convergence accelerator, one of METHODS ('crr', 'richardson', 'bbs', 'bbsr' or 'analytic'). Defaults to 'crr', the plain tree. 'richardson' needs model 'lr'.
+    - model (str, optional): Lattice parameterization, one of MODELS ('crr', 'jr', 'tian', 'lr' or 'trinomial'). Defaults to 'crr'.
+
+    Returns:
+        - result (np.ndarray): Structured array with the broadcast shape of the inputs and the fields 'price', 'u', 'd' and 'p' (the probability of the up move) for each contract, plus 'error' (the method's error estimate) unless method is 'crr', and 'delta', 'gamma', 'theta', 'vega' and 'rho' if greeks is True.
+    '''
+    S0, K, T, r, v, opt_type, deriv_type = np.broadcast_arrays(
+        np.asarray(S0, dtype = float), np.asarray(K, dtype = float), np.asarray(T, dtype = float),
+        np.asarray(r, dtype = float), np.asarray(v, dtype = float), np.asarray(opt_type), np.asarray(deriv_type)
+    )
+    shape = S0.shape
+
+    # Flatten every input to a row of contracts so that the tree levels run down the first axis
+    S0, K, T, r, v = (x.ravel() for x in (S0, K, T, r, v))
+    is_call = opt_type.ravel() == 'Call'
+    is_american = deriv_type.ravel() == 'American'
+
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}, not {method!r}')
+
+    fields = ['price', 'u', 'd', 'p']
+    if method != 'crr':
+        fields += ['error']
+    if greeks:
+        fields += ['delta', 'gamma', 'theta', 'vega', 'rho']
+
+    result = np.empty(S0.size, dtype = [(name, float) for name in fields])
+
+    N = _model_steps(N, model)
+    u, d, probs, disc = _lattice_params(S0, K, T, N, r, v, model)
+    if S0.size == 0:
+        return result.reshape(shape)
+
+    levels = {0: None, 1: None, 2: None} if greeks else None
+    price, error = _accelerated_price(S0, K, T, N, r, v, is_call, is_american, method, None if method == 'analytic' else levels, model)
+
+    # The closed form has no tree to read the Greeks off, so use the Binomial Black-Scholes tree for them
+    if greeks and method == 'analytic':
+        _backward_induction(S0, K, N, u, d, probs, disc, is_call, is_american, levels, (r, v, T/N))
+
+    result['price'] = price
+    result['u'] = u
+    result['d'] = d
+    result['p'] = probs[-1]
+
+    if method != 'crr':
+        result['error'] = error
+
+    if greeks:
+        values = _lattice_greeks(S0, u, d, T/N, levels[0][0], levels[1], levels[2])
+        values.update(_bumped_greeks(S0, K, T, N, r, v, is_call, is_american, model))
+        for name, value in values.items():
+            result[name] = value
+
+    return result.reshape(shape)
+
+# Standard normal cumulative distribution function (Hart's double precision algorithm), vectorized
+def _norm_cdf(x) -> np.ndarray:
+    x = np.asarray(x, dtype = float)
+    a = np.abs(x)
+    e = np.exp(-a * a / 2)
+
+    # Rational approximation near the centre
+    n = ((((((3.52624965998911e-02 * a + 0.700383064443688) * a + 6.37396220353165) * a + 33.912866078383) * a
+           + 112.079291497871) * a + 221.213596169931) * a + 220.206867912376)
+    m = (((((((8.83883476483184e-02 * a + 1.75566716318264) * a + 16.064177579207) * a + 86.7807322029461) * a
+            + 296.564248779674) * a + 637.333633378831) * a + 793.826512519948) * a + 440.413735824752)
+    near = e * n / m
+
+    # Continued fraction in the tails
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        far = e / (a + 1 / (a + 2 / (a + 3 / (a + 4 / (a + 0.65))))) / 2.506628274631
+
+    c = np.where(a < 7.07106781186547, near, far)
+    c = np.where(a > 37, 0.0, c)
+    return np.where(x > 0, 1 - c, c)
+
+# Get the Black-Scholes price of European options, the limit of the binomial tree as N grows
+def black_scholes(S0, K, T, r, v, opt_type = 'Call') -> np.ndarray:
+    '''
+    Calculates the price of European options with the Black-Scholes formula. All inputs are broadcast.
+
+    Parameters:
+    - S0 (array_like): Initial stock prices
+    - K (array_like): Strike prices
+    - T (array_like): Times to maturity in years
+    - r (array_like): Annual discount rates (Continuous compounding)
+    - v (array_like): Annual stock volatilities
+    - opt_type (array_like, optional): Option types ('Call' or 'Put'). Defaults to 'Call'.
+
+    Returns:
+        - price (np.ndarray): The option values at time 0.
+    '''
+    S0, K, T, r, v = (np.asarray(x, dtype = float) for x in (S0, K, T, r, v))
+    return _black_scholes(S0, K, T, r, v, np.where(np.asarray(opt_type) == 'Call', 1.0, -1.0))
+
+# Black-Scholes price with the option type given as +1 (call) or -1 (put)
+def _black_scholes(S0, K, T, r, v, sign) -> np.ndarray:
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        vol = v * np.sqrt(T)
+        d1 = (np.log(S0 / K) + (r + v * v / 2) * T) / vol
+        d2 = d1 - vol
+
+    price = sign * (S0 * _norm_cdf(sign * d1) - K * np.exp(-r * T) * _norm_cdf(sign * d2))
+
+    # Zero volatility leaves only the discounted forward payoff
+    intrinsic = np.maximum(sign * (S0 - K * np.exp(-r * T)), 0)
+    return np.where(vol > 0, price, intrinsic)
+
+# Status codes reported by implied_volatility
+IV_CONVERGED = 0
+IV_MAX_ITER = 1
+IV_NO_SOLUTION = 2
+
+# Bracket searched by implied_volatility
+IV_MIN = 1e-4
+IV_MAX = 5.0
+
+# Corrado-Miller estimate of the Black-Scholes implied volatility, polished with a few closed-form Newton steps
+def _iv_warm_start(price, S0, K, T, r, is_call) -> np.ndarray:
+    X = K * np.exp(-r * T)
+
+    # Work with call prices, converting puts through put-call parity
+    C = np.where(is_call, price, price + S0 - X)
+    half = C - (S0 - X) / 2
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        v = np.sqrt(2 * np.pi / T) / (S0 + X) * (half + np.sqrt(np.maximum(half ** 2 - (S0 - X) ** 2 / np.pi, 0)))
+        v = np.clip(np.nan_to_num(v, nan = 0.3), IV_MIN, IV_MAX)
+
+        for _ in range(3):
+            d1 = (np.log(S0 / K) + (r + v * v / 2) * T) / (v * np.sqrt(T))
+            vega = S0 * np.sqrt(T) * np.exp(-d1 * d1 / 2) / np.sqrt(2 * np.pi)
+            step = (black_scholes(S0, K, T, r, v, 'Call') - C) / vega
+            v = np.clip(np.where(vega > 1e-8, v - step, v), IV_MIN, IV_MAX)
+
+    return v
+
+# Solve for the volatilities that reproduce a vector of option prices under the binomial tree
+def implied_volatility(price, S0, K, T, N: int, r, opt_type = 'Call', deriv_type = 'European', tol: float = 1e-8, max_iter: int = 50, model: str = 'crr') -> np.ndarray:
+    '''
+    Calculates the implied volatilities of many European and/or American options at once by inverting the Binomial
+    Options Pricing Model. All contract inputs are broadcast against each other.
+
+    Each iteration prices every unconverged contract, together with a small volatility bump for the slope, in one
+    pass of the tree. The Newton step is safeguarded by a per-contract bracket and falls back to bisection whenever
+    it would leave the bracket. The search starts from a Black-Scholes estimate and converged contracts drop out.
+
+    Parameters:
+    - price (array_like): Market prices of the options
+    - S0 (array_like): Initial stock prices
+    - K (array_like): Strike prices
+    - T (array_like): Times to maturity in years
+    - N (int): Number of time steps (shared by every contract, rounded up to the next odd number for 'lr')
+    - r (array_like): Annual discount rates (Continuous compounding)
+    - opt_type (array_like, optional): Option types ('Call' or 'Put'). Defaults to 'Call'.
+    - deriv_type (array_like, optional): Derivative types ('European' or 'American'). Defaults to 'European'.
+    - tol (float, optional): Tolerance on the price error (and on the bracket width). Defaults to 1e-8.
+    - max_iter (int, optional): Maximum number of tree passes per contract. Defaults to 50.
+    - model (str, optional): Lattice parameterization, one of MODELS ('crr', 'jr', 'tian', 'lr' or 'trinomial'). Defaults to 'crr'.
+
+    Returns:
+        - result (np.ndarray): Structured array with the broadcast shape of the inputs and the fields 'v' (the implied volatility, NaN if unsolved), 'status' (IV_CONVERGED, IV_MAX_ITER or IV_NO_SOLUTION) and 'iterations' for each contract.
+    '''
+    price, S0, K, T, r, opt_type, deriv_type = np.broadcast_arrays(
+        np.asarray(price, dtype = float), np.asarray(S0, dtype = float), np.asarray(K, dtype = float),
+        np.asarray(T, dtype = float), np.asarray(r, dtype = float), np.asarray(opt_type), np.asarray(deriv_type)
+    )
+    shape = price.shape
+
+    price, S0, K, T, r = (x.ravel() for x in (price, S0, K, T, r))
+    is_call = opt_type.ravel() == 'Call'
+    is_american = deriv_type.ravel() == 'American'
+    N = _model_steps(N, model)
+
+    # Price each contract of the subset `idx` at the volatilities `v`, which may carry extra leading axes
+    def tree_price(idx, v):
+        u, d, probs, disc = _lattice_params(S0[idx], K[idx], T[idx], N, r[idx], v, model)
+        return _backward_induction(S0[idx], K[idx], N, u, d, probs, disc, is_call[idx], is_american[idx])
+
+    result = np.zeros(price.size, dtype = [('v', float), ('status', np.int8), ('iterations', np.int32)])
+    if price.size == 0:
+        return result.reshape(shape)
+
+    result['v'] = np.nan
+    result['status'] = IV_MAX_ITER
+
+    # The tree needs u > exp(r * dt), i.e. a volatility above r * sqrt(dt), for p to stay below 1
+    lo = np.maximum(IV_MIN, 1.001 * np.abs(r) * np.sqrt(T/N))
+    hi = np.full(price.size, IV_MAX)
+
+    # Prices at the ends of the bracket, in one pass. Quotes outside them have no solution.
+    lo_price, hi_price = tree_price(np.arange(price.size), np.stack([lo, hi]))
+    solvable = (price >= lo_price - tol) & (price <= hi_price + tol)
+    result['status'][~solvable] = IV_NO_SOLUTION
+    result['iterations'][:] = 1
+
+    v = np.clip(_iv_warm_start(price, S0, K, T, r, is_call), lo, hi)
+
+    h = 1e-6
+    active = np.flatnonzero(solvable)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+
+        # Price and bumped price of every unconverged contract side by side
+        value, bumped = tree_price(active, np.stack([v[active], v[active] + h]))
+        result['iterations'][active] += 1
+        error = value - price[active]
+
+        # Shrink the bracket around the root
+        over = error > 0
+        hi[active] = np.where(over, v[active], hi[active])
+        lo[active] = np.where(over, lo[active], v[active])
+
+        done = (np.abs(error) < tol) | (hi[active] - lo[active] < tol)
+        result['v'][active[done]] = v[active[done]]
+        result['status'][active[done]] = IV_CONVERGED
+
+        # Newton step, or bisection if it is undefined or leaves the bracket
+        slope = (bumped - value) / h
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            step = v[active] - error / slope
+        bisect = (hi[active] + lo[active]) / 2
+        inside = np.isfinite(step) & (step > lo[active]) & (step < hi[active])
+        v[active] = np.where(inside, step, bisect)
+
+        active = active[~done]
+
+    return result.reshape(shape)
+
+# Generate the pairs of linked nodes
+def generate_step_pairs(steps: int) -> np.ndarray:
+    '''
+    Gets every edge of a tree with `steps` time steps as an integer array of (parent, child) node numbers, in closed
+    form: node n at step k links to nodes n + k + 1 (up) and n + k + 2 (down).
+
+    Returns:
+        - pairs (np.ndarray): Array of shape (steps * (steps + 1), 2), with the up and down edges of each parent next to each other.
+    '''
+    k = np.repeat(np.arange(steps), np.arange(1, steps + 1))
+    n = np.arange(1, k.size + 1)
+
+    pairs = np.empty((k.size, 2, 2), dtype = np.int64)
+    pairs[:, :, 0] = n[:, None]
+    pairs[:, 0, 1] = n + k + 1
+    pairs[:, 1, 1] = n + k + 2
+
+    return pairs.reshape(-1, 2)
+
+# Format the graphviz label of each node once
+def _node_labels(nodes: np.ndarray, prices: np.ndarray, payoffs: np.ndarray) -> List[str]:
+    return [f'"Price {n}: {price}\\lPayoff {n}: {payoff}\\l"' for n, price, payoff in zip(np.asarray(nodes).tolist(), np.round(prices, 4).tolist(), np.round(payoffs, 4).tolist())]
+
+# Get final pairs as full string to be displayed in graphviz chart
+def final_pairs_str(pp_dict: Mapping, all_pairs) -> str:
+    '''
+    Declares each node once, with its label, and then links the nodes by number, so the DOT source grows with the
+    number of nodes rather than repeating both labels on every edge.
+    '''
+    lattice = getattr(pp_dict, 'lattice', None)
+    if lattice is not None:
+        nodes = np.arange(1, len(lattice) + 1)
+        labels = _node_labels(nodes, lattice.prices, lattice.payoffs)
+    else:
+        nodes = list(pp_dict)
+        labels = _node_labels(nodes, [pp_dict[i][0] for i in nodes], [pp_dict[i][1] for i in nodes])
+
+    declarations = [f'n{n} [label={label}]' for n, label in zip(np.asarray(nodes).tolist(), labels)]
+    edges = [f'n{a} -> n{b}' for a, b in np.asarray(all_pairs).tolist()]
+
+    return '\n'.join(declarations + edges)
+
+# Ways of drawing a tree, from every node to a summary that stays the same size whatever N is
+LOD_MODES = ('auto', 'full', 'collapse', 'topk', 'heatmap')
+
+# Most nodes drawn by the level-of-detail modes, which keeps the DOT source and the graphviz layout time bounded
+LOD_MAX_NODES = 400
+
+# Size of the heatmap grid: price buckets by time steps
+HEATMAP_ROWS = 24
+HEATMAP_COLUMNS = 40
+
+# Whether every node of a tree with N steps fits in the node budget
+def lod_full_fits(N: int, max_nodes: int = LOD_MAX_NODES) -> bool:
+    return (N + 1) * (N + 2) // 2 <= max_nodes
+
+# Resolve 'auto' to the mode used to draw a tree with N steps. 'full' falls back to 'topk' once the tree has more
+# than max_nodes nodes, so that no mode can blow the DOT size or layout time budget.
+def lod_mode(N: int, mode: str = 'auto', max_nodes: int = LOD_MAX_NODES) -> str:
+    if mode not in LOD_MODES:
+        raise ValueError(f'mode must be one of {LOD_MODES}, not {mode!r}')
+    if mode in ('auto', 'full'):
+        return 'full' if lod_full_fits(N, max_nodes) else 'topk'
+    return mode
+
+# Number of leading time steps drawn in full by the 'collapse' mode
+def _collapse_head(N: int, max_nodes: int, k: int) -> int:
+    budget = max(1, max_nodes - 2 * k - 2)
+    head = int((np.sqrt(8 * budget + 1) - 1) // 2)
+    return max(1, min(head, N))
+
+def lod_steps(N: int, mode: str = 'auto', max_nodes: int = LOD_MAX_NODES, k: int = 3) -> np.ndarray:
+    '''
+    Gets the time steps whose nodes a level-of-detail mode draws.
+
+    - 'full': every step.
+    - 'collapse': as many leading steps as fit in `max_nodes`, then the maturity step.
+    - 'topk': evenly spaced steps (always including 0 and N), with at most 2k + 1 nodes drawn per step.
+    - 'heatmap': up to HEATMAP_COLUMNS evenly spaced steps.
+    '''
+    mode = lod_mode(N, mode, max_nodes)
+    if mode == 'full':
+        return np.arange(N + 1)
+    if mode == 'collapse':
+        return np.unique(np.r_[np.arange(_collapse_head(N, max_nodes, k)), N])
+
+    count = max(2, max_nodes // (2 * k + 2)) if mode == 'topk' else HEATMAP_COLUMNS
+    return np.unique(np.linspace(0, N, min(N + 1, count)).round().astype(int))
+
+# Positions (0 is the highest price) of the nodes drawn at a step: the top k and bottom k
+def _shown_positions(step: int, k: int) -> np.ndarray:
+    if step + 1 <= 2 * k:
+        return np.arange(step + 1)
+    return np.r_[0:k, step+1-k:step+1]
+
+# Declare the top and bottom k nodes of each level, with one placeholder for the nodes in between
+def _lod_declarations(levels: Dict[int, Tuple[np.ndarray, np.ndarray]], k: int) -> List[str]:
+    declarations = []
+    for i, (prices, payoffs) in sorted(levels.items()):
+        shown = _shown_positions(i, k)
+        nodes = i * (i + 1) // 2 + 1 + shown
+        for n, label in zip(nodes.tolist(), _node_labels(nodes, prices[shown], payoffs[shown])):
+            declarations.append(f'n{n} [label={label}]')
+        if shown.size < i + 1:
+            hidden = i + 1 - shown.size
+            declarations.append(f'e{i} [label="... {hidden} node{"s" if hidden > 1 else ""} ..." shape="plaintext"]')
+
+    return declarations
+
+# Link the drawn nodes of step a to those of step b > a
+def _lod_edges(a: int, b: int, k: int) -> List[str]:
+    shown_b = set(_shown_positions(b, k).tolist())
+    start_a, start_b = a * (a + 1) // 2 + 1, b * (b + 1) // 2 + 1
+    hidden_a, hidden_b = a + 1 > 2 * k, b + 1 > 2 * k
+
+    edges = {}
+    for pos in _shown_positions(a, k).tolist():
+        if b == a + 1:
+            # Real edges, redirected to the placeholder when the child is not drawn
+            for child in (pos, pos + 1):
+                edges[f'n{start_a + pos} -> ' + (f'n{start_b + child}' if child in shown_b else f'e{b}')] = None
+        else:
+            # Steps in between are skipped, so link nodes of the same rank from the top or the bottom
+            child = pos if pos < k or not hidden_a and pos <= a // 2 else b - (a - pos)
+            edges[f'n{start_a + pos} -> n{start_b + child} [style="dashed"]'] = None
+
+    if hidden_a and hidden_b:
+        edges[f'e{a} -> e{b}' + (' [style="dashed"]' if b > a + 1 else '')] = None
+
+    return list(edges)
+
+def level_of_detail_str(levels: Dict[int, Tuple[np.ndarray, np.ndarray]], N: int, mode: str = 'auto', max_nodes: int = LOD_MAX_NODES, k: int = 3) -> str:
+    '''
+    Gets the graphviz statements for a large tree, drawing at most about `max_nodes` nodes whatever N is.
+
+    Parameters:
+    - levels (Dict[int, Tuple[np.ndarray, np.ndarray]]): Prices and payoffs, highest price first, at (at least) the steps returned by lod_steps
+    - N (int): Number of time steps of the tree
+    - mode (str, optional): One of LOD_MODES. 'collapse' draws the first steps in full and replaces the rest up to maturity with a single node, 'topk' draws only the top and bottom k nodes of evenly spaced steps, and 'heatmap' draws the mean payoff of buckets of nodes by price and step. 'full' and the default 'auto' draw every node if the whole tree fits in max_nodes and fall back to 'topk' otherwise.
+    - max_nodes (int, optional): Node budget. Defaults to LOD_MAX_NODES.
+    - k (int, optional): Nodes drawn at the top and the bottom of each step. Defaults to 3.
+
+    Returns:
+        - statements (str): The body of the DOT digraph.
+    '''
+    mode = lod_mode(N, mode, max_nodes)
+    steps = lod_steps(N, mode, max_nodes, k).tolist()
+    levels = {i: levels[i] for i in steps}
+
+    if mode == 'heatmap':
+        return _heatmap_str(levels)
+
+    if mode == 'full':
+        k = N + 1
+    declarations = _lod_declarations(levels, k)
+
+    if mode == 'collapse' and len(steps) > 1 and steps[-2] < N - 1:
+        head = steps[-2]
+        hidden = (N * (N + 1) - (head + 1) * (head + 2)) // 2
+        declarations.append(f'c [label="Steps {head + 1} to {N - 1}\\l{hidden} nodes not drawn\\l" style="dashed"]')
+        edges = [edge for a, b in zip(steps[:-2], steps[1:-1]) for edge in _lod_edges(a, b, k)]
+        start = head * (head + 1) // 2 + 1
+        edges += [f'n{start + pos} -> c' for pos in _shown_positions(head, k).tolist()]
+        start = N * (N + 1) // 2 + 1
+        edges += [f'c -> n{start + pos} [style="dashed"]' for pos in _shown_positions(N, k).tolist()]
+        if N + 1 > 2 * k:
+            edges.append(f'c -> e{N} [style="dashed"]')
+    else:
+        edges = [edge for a, b in zip(steps[:-1], steps[1:]) for edge in _lod_edges(a, b, k)]
+
+    return '\n'.join(declarations + edges)
+
+# Hex colour for a value in [0, 1], from white to dark green
+def _heat_colour(x: float) -> str:
+    low, high = np.array([255, 255, 255]), np.array([27, 94, 32])
+    r, g, b = np.round(low + (high - low) * x).astype(int)
+    return f'#{r:02X}{g:02X}{b:02X}'
+
+# Bucket the nodes of each drawn step by log price and draw the mean payoff of each bucket as one HTML table
+def _heatmap_str(levels: Dict[int, Tuple[np.ndarray, np.ndarray]], rows: int = HEATMAP_ROWS) -> str:
+    steps = sorted(levels)
+    logs = {i: np.log(np.maximum(levels[i][0], np.finfo(float).tiny)) for i in steps}
+    lo = min(x.min() for x in logs.values())
+    hi = max(x.max() for x in logs.values())
+    width = (hi - lo) / rows if hi > lo else 1.0
+
+    grid = np.full((rows, len(steps)), np.nan)
+    for col, i in enumerate(steps):
+        bucket = np.minimum(((logs[i] - lo) / width).astype(int), rows - 1)
+        counts = np.bincount(bucket, minlength = rows)
+        sums = np.bincount(bucket, levels[i][1], minlength = rows)
+        with np.errstate(invalid = 'ignore'):
+            grid[:, col] = sums / counts
+
+    top = np.nanmax(grid) if np.nanmax(grid) > 0 else 1.0
+    font = '<FONT POINT-SIZE="8">{}</FONT>'
+
+    html = [f'<TR><TD COLSPAN="{len(steps) + 1}">Mean payoff by stock price (rows) and time step (columns), max {np.round(top, 4)}</TD></TR>']
+    html.append('<TR><TD></TD>' + ''.join(f'<TD>{font.format(i)}</TD>' for i in steps) + '</TR>')
+
+    # Highest prices on top, like the tree
+    for row in range(rows - 1, -1, -1):
+        cells = [f'<TD ALIGN="RIGHT">{font.format(f"{np.exp(lo + row * width):.4g}")}</TD>']
+        for value in grid[row].tolist():
+            if np.isnan(value):
+                cells.append('<TD WIDTH="14" HEIGHT="14"></TD>')
+            else:
+                cells.append(f'<TD WIDTH="14" HEIGHT="14" BGCOLOR="{_heat_colour(value / top)}" TOOLTIP="{np.round(value, 4)}"></TD>')
+        html.append('<TR>' + ''.join(cells) + '</TR>')
+
+    return f'heatmap [shape="plaintext" label=<<TABLE BORDER="0" CELLBORDER="0" CELLSPACING="1">{"".join(html)}</TABLE>>]'
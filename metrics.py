@@ -0,0 +1,205 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from functools import wraps
+from typing import Callable, Dict, List
+
+from cache import cache_stats
+
+# Stage timings for the app's hot paths: nanosecond wall time, net allocated memory blocks and node counts per call.
+# The block counts come from sys.getallocatedblocks(), so they are a process-wide net delta: on a shared server they
+# include whatever other sessions and the export pool allocated or freed during the stage.
+# Off unless BOPM_METRICS is set, in which case every rerun is logged as one JSON line on stderr and the running
+# totals are written to a Prometheus text file. BOPM_PROFILE also runs each rerun under cProfile.
+#
+#   BOPM_METRICS=1 BOPM_METRICS_FILE=/tmp/bopm.prom streamlit run app.py
+
+PROMETHEUS_PATH = os.environ.get('BOPM_METRICS_FILE', 'bopm_metrics.prom')
+PROFILE_PATH = os.environ.get('BOPM_PROFILE_FILE', 'bopm_profile.prof')
+
+_enabled = os.environ.get('BOPM_METRICS', '') not in ('', '0')
+_profile = os.environ.get('BOPM_PROFILE', '') not in ('', '0')
+
+_log = logging.getLogger('bopm.metrics')
+
+# Running totals per stage, shared by every session and thread in the process
+_totals: Dict[str, Dict[str, int]] = {}
+_totals_lock = threading.Lock()
+
+# Calls recorded by the current rerun, per thread
+_local = threading.local()
+
+def enabled() -> bool:
+    return _enabled
+
+# Turn collection on or off for the whole process
+def enable(on: bool = True, profile: bool = None) -> None:
+    global _enabled, _profile
+    _enabled = on
+    if profile is not None:
+        _profile = profile
+
+    if on and not _log.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _log.addHandler(handler)
+        _log.setLevel(logging.INFO)
+        _log.propagate = False
+
+if _enabled:
+    enable()
+
+# Add one call of a stage to the running totals and to the current rerun
+def record(name: str, ns: int, blocks: int, nodes: int = 0) -> None:
+    with _totals_lock:
+        totals = _totals.setdefault(name, {'calls': 0, 'ns': 0, 'max_ns': 0, 'blocks': 0, 'nodes': 0})
+        totals['calls'] += 1
+        totals['ns'] += ns
+        totals['max_ns'] = max(totals['max_ns'], ns)
+        totals['blocks'] += blocks
+        totals['nodes'] += nodes
+
+    calls = getattr(_local, 'calls', None)
+    if calls is not None:
+        calls.append({'stage': name, 'ms': ns / 1e6, 'blocks': blocks, 'nodes': nodes})
+
+# Context manager that times a block as one call of a stage
+class stage:
+    __slots__ = ('name', 'nodes', 'start', 'blocks')
+
+    def __init__(self, name: str, nodes: int = 0):
+        self.name = name
+        self.nodes = nodes
+
+    def __enter__(self) -> 'stage':
+        if _enabled:
+            self.blocks = sys.getallocatedblocks()
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if _enabled:
+            ns = time.perf_counter_ns() - self.start
+            record(self.name, ns, sys.getallocatedblocks() - self.blocks, self.nodes)
+
+def timed(name: str, nodes: Callable = None) -> Callable:
+    '''
+    Decorator that records every call of a function as one call of the stage `name`. `nodes`, if given, gets the
+    call arguments and returns the number of tree nodes the call handles. When collection is off, the only cost is
+    one flag check per call.
+    '''
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            blocks = sys.getallocatedblocks()
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ns = time.perf_counter_ns() - start
+                record(name, ns, sys.getallocatedblocks() - blocks, nodes(*args, **kwargs) if nodes else 0)
+
+        return wrapper
+
+    return decorator
+
+# Number of nodes in a tree with N steps
+def tree_nodes(S0, K, T, N, *args, **kwargs) -> int:
+    return (N + 1) * (N + 2) // 2
+
+# Record one rerun of the app: run it (under cProfile if profiling), then log it and refresh the Prometheus file
+class rerun:
+    '''
+    Context manager around one run of the app script. On exit the stages called on this thread are logged as one
+    JSON line, the Prometheus file is rewritten, and the summary is kept for the debug panel (see last_rerun).
+    '''
+    def __init__(self, **labels):
+        self.labels = labels
+        self.profiler = None
+        self.start = None
+
+    def __enter__(self) -> 'rerun':
+        if not _enabled:
+            return self
+
+        _local.calls = []
+        if _profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.start is None:
+            return
+
+        ns = time.perf_counter_ns() - self.start
+        blocks = sys.getallocatedblocks() - self.blocks
+        calls = _local.calls
+        _local.calls = None
+        record('rerun', ns, blocks)
+
+        summary = {'event': 'rerun', 'ms': ns / 1e6, 'blocks': blocks, **self.labels, 'stages': calls}
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(PROFILE_PATH)
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream = out).sort_stats('cumulative').print_stats(20)
+            summary['profile'] = out.getvalue()
+
+        _local.last = summary
+        _log.info(json.dumps({key: value for key, value in summary.items() if key != 'profile'}, default = str))
+        write_prometheus()
+
+# Summary of the last rerun recorded on this thread. Every session runs its script on its own thread, so this is
+# never another user's rerun.
+def last_rerun() -> Dict:
+    return getattr(_local, 'last', None)
+
+# Snapshot of the running totals per stage
+def totals() -> Dict[str, Dict[str, int]]:
+    with _totals_lock:
+        return {name: dict(values) for name, values in _totals.items()}
+
+def prometheus_text() -> str:
+    '''
+    Formats the running totals and the artifact cache counters in the Prometheus text exposition format.
+    '''
+    stages = totals()
+    lines: List[str] = []
+
+    def family(metric: str, kind: str, help: str, samples) -> None:
+        lines.append(f'# HELP {metric} {help}')
+        lines.append(f'# TYPE {metric} {kind}')
+        lines.extend(f'{metric}{{{labels}}} {value}' for labels, value in samples)
+
+    family('bopm_stage_calls_total', 'counter', 'Calls of each stage.', [(f'stage="{name}"', s['calls']) for name, s in stages.items()])
+    family('bopm_stage_seconds_total', 'counter', 'Wall time spent in each stage.', [(f'stage="{name}"', s['ns'] / 1e9) for name, s in stages.items()])
+    family('bopm_stage_max_seconds', 'gauge', 'Slowest call of each stage.', [(f'stage="{name}"', s['max_ns'] / 1e9) for name, s in stages.items()])
+    family('bopm_stage_alloc_blocks', 'gauge', 'Process-wide net change in allocated memory blocks during each stage, including other threads.', [(f'stage="{name}"', s['blocks']) for name, s in stages.items()])
+    family('bopm_stage_nodes_total', 'counter', 'Tree nodes handled by each stage.', [(f'stage="{name}"', s['nodes']) for name, s in stages.items()])
+
+    caches = cache_stats()
+    for field, kind in [('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')]:
+        metric = f'bopm_cache_{field}_total' if kind == 'counter' else f'bopm_cache_{field}'
+        family(metric, kind, f'Artifact cache {field}.', [(f'cache="{name}"', s[field]) for name, s in caches.items()])
+
+    return '\n'.join(lines) + '\n'
+
+# Write the Prometheus text atomically, so a scraper never reads half a file
+def write_prometheus(path: str = None) -> None:
+    path = path or PROMETHEUS_PATH
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
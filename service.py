@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from cli import DEFAULTS, ERROR_COLUMN, GREEK_COLUMNS, NUMERIC_COLUMNS, RESULT_COLUMNS, price_chunk
+
+# Local HTTP/JSON pricing service. Requests that arrive within a short window are priced together as one batch by
+# the vectorized engine, behind a bounded queue that answers 503 when full.
+#
+#   python service.py serve --port 8765 --window-ms 2 --max-batch 256
+#   curl -d '{"S0": 100, "K": 100, "T": 1, "r": 0.05, "v": 0.2, "N": 200}' localhost:8765/price
+#   python service.py loadtest --requests 5000 --concurrency 64
+
+MAX_BODY = 64 * 2**10
+
+# Raised when the queue is full, answered with 503
+class Overloaded(Exception):
+    pass
+
+# Gathers single contracts into batches for the vectorized engine
+class MicroBatcher:
+    '''
+    Collects the contracts submitted within `window` seconds of the first one (or until `max_batch` have arrived)
+    and prices them with one call of the engine, in a worker thread so that the event loop keeps accepting requests.
+    While a batch is being priced, new requests queue up and form the next batch.
+
+    Parameters:
+    - window (float): Seconds to wait for more requests after the first one of a batch
+    - max_batch (int): Most contracts priced together
+    - max_queue (int): Most contracts waiting, beyond which submit raises Overloaded
+    - steps (int): Number of time steps N for contracts without one
+    - batch (bool): Price each contract on its own instead, for comparison
+    '''
+    def __init__(self, window: float = 0.002, max_batch: int = 256, max_queue: int = 4096, steps: int = 100, batch: bool = True):
+        self.window = window
+        self.max_batch = max_batch
+        self.steps = steps
+        self.batch = batch
+        self.queue = asyncio.Queue(max_queue)
+        self.batches = 0
+        self.priced = 0
+
+    async def submit(self, contract: Dict) -> Dict:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((contract, future))
+        except asyncio.QueueFull:
+            raise Overloaded()
+        return await future
+
+    # Wait for the first contract, then collect more until the window closes or the batch is full
+    async def _collect(self) -> List[Tuple[Dict, asyncio.Future]]:
+        items = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(items) < self.max_batch:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._collect() if self.batch else [await self.queue.get()]
+            contracts = [contract for contract, _ in items]
+            try:
+                with metrics.stage('service_batch', len(items)):
+                    results = await loop.run_in_executor(None, price_contracts, contracts, self.steps)
+            except Exception:
+                # Price the contracts one by one, so that only the one that fails gets the error
+                results = []
+                for contract in contracts:
+                    try:
+                        results.append((await loop.run_in_executor(None, price_contracts, [contract], self.steps))[0])
+                    except Exception as error:
+                        results.append(error)
+
+            self.batches += 1
+            self.priced += len(items)
+            for (_, future), result in zip(items, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+# JSON has no NaN or infinity (e.g. gamma of a one-step tree), so they are sent as null
+def _json_number(value) -> Optional[float]:
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+# Price a list of validated contracts with one call of the engine per distinct N and greeks flag. Contracts the
+# engine could not price get the exception instead of a result.
+def price_contracts(contracts: List[Dict], steps: int) -> List[Dict]:
+    results = [None] * len(contracts)
+
+    # Only the contracts that ask for the Greeks pay for the bumped trees
+    for greeks in (False, True):
+        rows = [row for row, contract in enumerate(contracts) if bool(contract.get('greeks')) == greeks]
+        if not rows:
+            continue
+
+        group = [contracts[row] for row in rows]
+        columns = {name: np.array([contract[name] for contract in group], dtype = float) for name in NUMERIC_COLUMNS}
+        columns['N'] = np.array([contract.get('N', steps) for contract in group])
+        for name, default in DEFAULTS.items():
+            columns[name] = np.array([contract.get(name, default) for contract in group])
+
+        out = price_chunk(columns, steps, greeks)
+        names = RESULT_COLUMNS + (GREEK_COLUMNS if greeks else [])
+        for i, row in enumerate(rows):
+            if out[ERROR_COLUMN][i]:
+                # Answered with 500, like any other engine failure
+                results[row] = ValueError(out[ERROR_COLUMN][i])
+            else:
+                results[row] = {name: _json_number(out[name][i]) for name in names}
+
+    return results
+
+# Check one JSON contract, returning an error message or None. `steps` is the N of contracts without one.
+def validate(contract, steps: int = 100) -> str:
+    if not isinstance(contract, dict):
+        return 'expected a JSON object'
+    missing = [name for name in NUMERIC_COLUMNS if name not in contract]
+    if missing:
+        return f'missing field(s) {", ".join(missing)}'
+    for name in NUMERIC_COLUMNS:
+        if not isinstance(contract[name], (int, float)) or isinstance(contract[name], bool):
+            return f'{name} must be a number'
+    if contract['T'] <= 0 or contract['v'] <= 0 or contract['S0'] <= 0:
+        return 'S0, T and v must be positive'
+    if 'N' in contract and (not isinstance(contract['N'], int) or not 1 <= contract['N'] <= 100000):
+        return 'N must be an integer between 1 and 100000'
+    if contract.get('opt_type', 'Call') not in ('Call', 'Put'):
+        return "opt_type must be 'Call' or 'Put'"
+    if contract.get('deriv_type', 'European') not in ('European', 'American'):
+        return "deriv_type must be 'European' or 'American'"
+    if not isinstance(contract.get('greeks', False), bool):
+        return 'greeks must be true or false'
+    # The up probability of the tree is only between 0 and 1 when v * sqrt(dt) exceeds |r| * dt
+    if contract['v'] <= abs(contract['r']) * np.sqrt(contract['T'] / contract.get('N', steps)):
+        return 'v must exceed |r| * sqrt(T / N), or the tree has no valid probabilities'
+    return None
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+async def _respond(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str = 'application/json', close: bool = False) -> None:
+    head = f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+    if close:
+        head += 'Connection: close\r\n'
+    writer.write(head.encode() + b'\r\n' + body)
+    await writer.drain()
+
+# Serve one keep-alive connection
+async def handle(batcher: MicroBatcher, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            method, path, _ = line.decode('latin-1').split(' ', 2)
+
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            close = headers.get('connection', '').lower() == 'close'
+            if length > MAX_BODY:
+                await _respond(writer, 413, b'{"error": "body too large"}', close = True)
+                return
+            body = await reader.readexactly(length) if length else b''
+
+            if path == '/health' and method == 'GET':
+                await _respond(writer, 200, json.dumps({'queued': batcher.queue.qsize(), 'batches': batcher.batches, 'priced': batcher.priced}).encode(), close = close)
+            elif path == '/metrics' and method == 'GET':
+                await _respond(writer, 200, metrics.prometheus_text().encode(), 'text/plain; version=0.0.4', close = close)
+            elif path != '/price':
+                await _respond(writer, 404, b'{"error": "not found"}', close = close)
+            elif method != 'POST':
+                await _respond(writer, 405, b'{"error": "use POST"}', close = close)
+            else:
+                status, result = await price_request(batcher, body)
+                await _respond(writer, status, json.dumps(result, allow_nan = False).encode(), close = close)
+
+            if close:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+# Parse, validate and price the body of one /price request
+async def price_request(batcher: MicroBatcher, body: bytes) -> Tuple[int, Dict]:
+    try:
+        contract = json.loads(body)
+    except ValueError:
+        return 400, {'error': 'body is not valid JSON'}
+
+    error = validate(contract, batcher.steps)
+    if error:
+        return 400, {'error': error}
+
+    try:
+        return 200, await batcher.submit(contract)
+    except Overloaded:
+        return 503, {'error': 'queue full, retry later'}
+    except Exception as error:
+        # The contract passed validation, so a failure here is the engine's
+        return 500, {'error': str(error)}
+
+async def serve(host: str = '127.0.0.1', port: int = 8765, batcher: MicroBatcher = None, ready: asyncio.Event = None) -> None:
+    batcher = batcher or MicroBatcher()
+    worker = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(lambda r, w: handle(batcher, r, w), host, port)
+    print(f'Pricing service on http://{host}:{port}/price', file = sys.stderr)
+    if ready is not None:
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+# One keep-alive client connection sending `count` requests back to back, recording each latency
+async def _client(host: str, port: int, bodies: List[bytes], latencies: List[float], statuses: Dict[int, int]) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            start = time.perf_counter()
+            writer.write(f'POST /price HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+async def loadtest(requests: int = 5000, concurrency: int = 64, steps: int = 100, window: float = 0.002, max_batch: int = 256, port: int = 8765) -> List[Dict]:
+    '''
+    Starts the service in this process, once with micro-batching and once pricing one contract per request, and
+    fires `requests` random contracts from `concurrency` keep-alive connections at each.
+
+    Returns:
+        - rows (List[Dict]): Throughput and p50/p99 latency for each mode.
+    '''
+    rng = np.random.default_rng(0)
+    bodies = [json.dumps({
+        'S0': 100.0, 'K': float(rng.uniform(80, 120)), 'T': float(rng.uniform(0.1, 2)), 'r': 0.05, 'v': float(rng.uniform(0.1, 0.5)),
+        'N': steps, 'opt_type': str(rng.choice(['Call', 'Put'])), 'deriv_type': str(rng.choice(['European', 'American'])),
+    }).encode() for _ in range(requests)]
+
+    rows = []
+    for batch in (True, False):
+        batcher = MicroBatcher(window, max_batch, max(4096, requests), steps, batch)
+        ready = asyncio.Event()
+        server = asyncio.create_task(serve('127.0.0.1', port, batcher, ready))
+        await ready.wait()
+
+        latencies, statuses = [], {}
+        start = time.perf_counter()
+        await asyncio.gather(*(_client('127.0.0.1', port, bodies[i::concurrency], latencies, statuses) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        row = {'mode': 'micro-batched' if batch else 'one call per request', 'requests': len(latencies), 'seconds': elapsed,
+               'throughput': len(latencies) / elapsed, 'p50_ms': p50, 'p99_ms': p99, 'batches': batcher.batches, 'statuses': statuses}
+        rows.append(row)
+        print(f'{row["mode"]:22s} {row["throughput"]:10,.0f} req/s   p50 {p50:8.2f} ms   p99 {p99:8.2f} ms   {batcher.batches} batches', flush = True)
+
+    return rows
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Local HTTP/JSON pricing service with request micro-batching.')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    for name, help in [('serve', 'run the pricing service'), ('loadtest', 'compare micro-batching against one call per request')]:
+        sub = commands.add_parser(name, help = help)
+        sub.add_argument('--port', type = int, default = 8765, help = 'port to listen on (default: 8765)')
+        sub.add_argument('--steps', type = int, default = 100, help = 'number of time steps N for contracts without one (default: 100)')
+        sub.add_argument('--window-ms', type = float, default = 2.0, help = 'milliseconds to wait for more requests after the first of a batch (default: 2)')
+        sub.add_argument('--max-batch', type = int, default = 256, help = 'most contracts priced together (default: 256)')
+
+    serve_parser = commands.choices['serve']
+    serve_parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('--max-queue', type = int, default = 4096, help = 'most contracts waiting before answering 503 (default: 4096)')
+    serve_parser.add_argument('--no-batch', action = 'store_true', help = 'price each request on its own')
+
+    load_parser = commands.choices['loadtest']
+    load_parser.add_argument('--requests', type = int, default = 5000, help = 'requests per mode (default: 5000)')
+    load_parser.add_argument('--concurrency', type = int, default = 64, help = 'concurrent client connections (default: 64)')
+
+    args = parser.parse_args(argv)
+    window = args.window_ms / 1e3
+
+    if args.command == 'serve':
+        batcher = MicroBatcher(window, args.max_batch, args.max_queue, args.steps, not args.no_batch)
+        asyncio.run(serve(args.host, args.port, batcher))
+    else:
+        asyncio.run(loadtest(args.requests, args.concurrency, args.steps, window, args.max_batch, args.port))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import getpass
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+from funcs import Lattice, _model_steps, binomial_lattice
+
+# On-disk store of full lattices, shared by every process on the machine. Each lattice is one .npy file of shape
+# (2, nodes) holding the prices and payoffs, named by a content hash of its inputs, with a JSON sidecar for u, d, p.
+# Reads are memory-mapped, so opening a stored tree costs about the same whatever N is and levels or nodes are only
+# paged in when touched. Writes go to a temporary file that is atomically renamed into place, so concurrent workers
+# never see half a lattice.
+
+# Per user by default: the temporary directory is shared, and lattices are only read from a store its owner wrote
+_user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+STORE_PATH = os.environ.get('BOPM_STORE', os.path.join(tempfile.gettempdir(), f'bopm_lattices_{_user}'))
+STORE_MAX_BYTES = int(os.environ.get('BOPM_STORE_MAX_BYTES', 2 * 2**30))
+
+# Smaller trees are quicker to recompute than to read back from disk
+STORE_MIN_STEPS = 200
+
+# Bump when the file layout changes, so that old files are never read
+STORE_VERSION = 1
+
+# Sidecars without a lattice and temporary files older than this are left over from failed writes
+ORPHAN_SECONDS = 3600
+
+# Whether a directory of the store belongs to this user and nobody else can write to it
+def _private(path: str) -> bool:
+    if not hasattr(os, 'getuid'):
+        return True
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+class LatticeStore:
+    '''
+    Content-addressed, memory-mapped lattice store with a size-capped least-recently-used eviction policy.
+
+    Parameters:
+    - root (str): Directory of the store, created on first write
+    - max_bytes (int): Most bytes kept on disk. Files are evicted by last use (modification time, refreshed on every read) once a write takes the store over the cap.
+    '''
+    def __init__(self, root: str = STORE_PATH, max_bytes: int = STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Content hash of the lattice inputs
+    @staticmethod
+    def key(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, model: str = 'crr') -> str:
+        # 0.0 and -0.0 (and 1 and 1.0) must hash the same
+        params = [float(S0) + 0.0, float(K) + 0.0, float(T) + 0.0, int(N), float(r) + 0.0, float(v) + 0.0, opt_type, deriv_type, model, STORE_VERSION]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, model: str = 'crr') -> Tuple:
+        '''
+        Opens a stored lattice without reading it.
+
+        Returns:
+            - result (Tuple[float, float, float, Lattice] or None): u, d, p and a read-only Lattice backed by the memory-mapped file, or None if the lattice is not stored.
+        '''
+        key = self.key(S0, K, T, N, r, v, opt_type, deriv_type, model)
+        path = self._path(key)
+        try:
+            if not (_private(self.root) and _private(os.path.dirname(path))):
+                raise PermissionError(f'{self.root} is not private to this user')
+            with open(f'{path}.json') as f:
+                meta = json.load(f)
+            data = np.load(f'{path}.npy', mmap_mode = 'r')
+
+            # Only trust a lattice that is exactly the one asked for
+            n = _model_steps(N, model)
+            expected = {'key': key, 'version': STORE_VERSION, 'S0': float(S0), 'K': float(K), 'T': float(T), 'N': n, 'r': float(r), 'v': float(v),
+                        'opt_type': opt_type, 'deriv_type': deriv_type, 'model': model}
+            if any(meta.get(name) != value for name, value in expected.items()):
+                raise ValueError('sidecar does not match the request')
+            if data.dtype != np.float64 or data.shape != (2, (n + 1) * (n + 2) // 2):
+                raise ValueError('lattice has the wrong shape')
+            u, d, p = (float(meta[name]) for name in ('u', 'd', 'p'))
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing, unreadable, not fully written or not what was asked for: build the lattice instead
+            self.misses += 1
+            return None
+
+        # Mark the lattice as recently used. Files of other users or a read-only store keep their old time.
+        try:
+            os.utime(f'{path}.npy')
+        except OSError:
+            pass
+
+        self.hits += 1
+        return u, d, p, Lattice(n, data[0], data[1])
+
+    def put(self, S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str, deriv_type: str, u: float, d: float, p: float, lattice: Lattice, model: str = 'crr') -> None:
+        key = self.key(S0, K, T, N, r, v, opt_type, deriv_type, model)
+        path = self._path(key)
+        os.makedirs(self.root, mode = 0o700, exist_ok = True)
+        os.makedirs(os.path.dirname(path), mode = 0o700, exist_ok = True)
+        if not (_private(self.root) and _private(os.path.dirname(path))):
+            raise PermissionError(f'{self.root} is not private to this user')
+
+        # The sidecar goes first: a lattice only counts as stored once its .npy file is in place
+        meta = {'key': key, 'version': STORE_VERSION, 'S0': float(S0), 'K': float(K), 'T': float(T), 'N': lattice.N, 'r': float(r), 'v': float(v), 'opt_type': opt_type, 'deriv_type': deriv_type, 'model': model,
+                'u': float(u), 'd': float(d), 'p': float(p), 'created': time.time()}
+        self._write_atomic(f'{path}.json', lambda tmp: _write_json(tmp, meta))
+        self._write_atomic(f'{path}.npy', lambda tmp: _write_lattice(tmp, lattice))
+
+        self.evict()
+
+    # Write to a temporary file in the same directory, then rename it over the target in one step
+    @staticmethod
+    def _write_atomic(path: str, write) -> None:
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def evict(self) -> int:
+        '''
+        Removes the least recently used lattices until the store is under max_bytes, as well as sidecars and
+        temporary files that failed writes left behind over ORPHAN_SECONDS ago. Files another process removes at the
+        same time are skipped. Lattices that are still memory-mapped stay readable until they are closed.
+
+        Returns:
+            - removed (int): Number of lattices removed.
+        '''
+        entries = []
+        total = 0
+        cutoff = time.time() - ORPHAN_SECONDS
+        for folder, _, files in os.walk(self.root):
+            names = set(files)
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                if name.endswith('.npy'):
+                    entries.append((stat.st_mtime, stat.st_size, path[:-len('.npy')]))
+                    total += stat.st_size
+                elif stat.st_mtime < cutoff and (name.endswith('.tmp') or (name.endswith('.json') and name[:-len('.json')] + '.npy' not in names)):
+                    try:
+                        os.remove(path)
+                    except (FileNotFoundError, PermissionError):
+                        pass
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for suffix in ('.npy', '.json'):
+                try:
+                    os.remove(path + suffix)
+                except (FileNotFoundError, PermissionError):
+                    pass
+            total -= size
+            removed += 1
+
+        self.evictions += removed
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+def _write_json(path: str, meta: Dict) -> None:
+    with open(path, 'w') as f:
+        json.dump(meta, f)
+
+# Write the prices and payoffs straight into a .npy file, without stacking them in memory first
+def _write_lattice(path: str, lattice: Lattice) -> None:
+    data = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float64, shape = (2, len(lattice)))
+    data[0] = lattice.prices
+    data[1] = lattice.payoffs
+    data.flush()
+    del data
+
+# Process-wide store used by the app
+_store = LatticeStore()
+
+def get_store() -> LatticeStore:
+    return _store
+
+def stored_lattice(S0: float, K: float, T: float, N: int, r: float, v: float, opt_type: str = 'Call', deriv_type: str = 'European', model: str = 'crr') -> Tuple:
+    '''
+    Gets the full lattice from the store, or builds it with binomial_lattice and stores it. Trees with fewer than
+    STORE_MIN_STEPS steps are always built in memory.
+
+    Returns:
+        - u (float): The up rate of the stock price.
+        - d (float): The down rate of the stock price.
+        - p (float): The probability of the up rate.
+        - lattice (Lattice): The price and payoff amount for each node, read-only.
+    '''
+    store = get_store()
+    if N >= STORE_MIN_STEPS:
+        found = store.get(S0, K, T, N, r, v, opt_type, deriv_type, model)
+        if found is not None:
+            return found
+
+    u, d, p, lattice = binomial_lattice(S0, K, T, N, r, v, opt_type, deriv_type, model)
+    if N >= STORE_MIN_STEPS:
+        try:
+            store.put(S0, K, T, N, r, v, opt_type, deriv_type, u, d, p, lattice, model)
+        except OSError:
+            # A read-only or full disk only costs the reuse
+            pass
+
+    lattice.prices.flags.writeable = False
+    lattice.payoffs.flags.writeable = False
+    return u, d, p, lattice
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from funcs import MODELS, _backward_induction, _lattice_params, _model_steps, binomial_price, binomial_tree_batch
+
+# Calls with a large v * sqrt(T) carry most of their value far above the risk-neutral centre of the tree
+@pytest.mark.parametrize('model', MODELS)
+@pytest.mark.parametrize('T, N, v', [(10, 3000, 2.5), (10, 500, 1.2), (5, 3000, 0.8), (1, 2000, 0.3)])
+@pytest.mark.parametrize('is_call', [True, False])
+@pytest.mark.parametrize('is_american', [False, True])
+def test_truncated_window_matches_full_tree(model, T, N, v, is_call, is_american):
+    S0, K, r = 100.0, 100.0, 0.05
+    N = _model_steps(N, model)
+    u, d, probs, disc = _lattice_params(S0, K, T, N, r, v, model)
+
+    truncated = _backward_induction(S0, K, N, u, d, probs, disc, is_call, is_american)
+    full = _backward_induction(S0, K, N, u, d, probs, disc, is_call, is_american, truncate = False)
+
+    assert np.abs(truncated - full) <= 1e-12 * S0
+
+# A volatility below r * sqrt(dt) gives p > 1, and a zero volatility gives u = d. Neither may break the window
+# maths, or spoil the other contracts of a batch.
+@pytest.mark.parametrize('v', [0.014, 0.0])
+def test_degenerate_lattice_in_batch(v):
+    with np.errstate(all = 'ignore'):
+        alone = binomial_tree_batch([15.0], [14.0], 1, 20, 0.2, [v])['price']
+        batch = binomial_tree_batch([15.0, 15.0], [14.0, 14.0], 1, 20, 0.2, [v, 0.3])['price']
+
+    assert alone.shape == (1,)
+    assert np.isfinite(alone[0]) == (v > 0)
+    assert np.array_equal(batch[:1], alone, equal_nan = True)
+    assert batch[1] == pytest.approx(binomial_price(15.0, 14.0, 1, 20, 0.2, 0.3), abs = 1e-12)